@@ -0,0 +1,63 @@
+import math
+import time
+
+import basic_ops
+
+
+class Anytime:
+    """The wall-clock deadline of a generation run, and the best grid seen so far.
+
+    Generators offer their grid whenever it changes and keep the fullest one, so
+    that it can be returned when the deadline passes or the run is interrupted.
+    If on_snapshot is given, it is called with a snapshot of the best grid at most
+    every snapshot_interval seconds.
+    """
+
+    def __init__(self, dimensions, deadline=None, on_snapshot=None, snapshot_interval=1.0):
+        self.dimensions = dimensions
+        self.deadline = deadline  # In time.monotonic() seconds, None for no deadline
+        self.on_snapshot = on_snapshot
+        self.snapshot_interval = snapshot_interval
+        self.start_time = time.monotonic()
+        self.last_snapshot = self.start_time
+        self.best_occupancy = -1
+        self.best_words = []
+
+    def remaining(self):
+        """Returns the seconds left until the deadline."""
+        if self.deadline is None:
+            return math.inf
+        return self.deadline - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def offer(self, words_in_grid, occupancy):
+        """Keeps the words of the grid if it is the fullest so far, and emits a
+        snapshot if one is due."""
+        if occupancy > self.best_occupancy:
+            self.best_occupancy = occupancy
+            self.best_words = list(words_in_grid)
+
+        self.tick()
+
+    def tick(self):
+        """Emits a snapshot of the best grid, if one is due."""
+        if self.on_snapshot and time.monotonic() - self.last_snapshot >= self.snapshot_interval:
+            self.last_snapshot = time.monotonic()
+            self.on_snapshot(self.snapshot())
+
+    def best_grid(self):
+        """Returns a new grid with the best words placed on it."""
+        grid = basic_ops.create_empty_grid(self.dimensions)
+        for word in self.best_words:
+            basic_ops.add_word_to_grid(word, grid)
+        return grid
+
+    def snapshot(self):
+        return {
+            "elapsed": time.monotonic() - self.start_time,
+            "occupancy": self.best_occupancy,
+            "grid": self.best_grid().to_lists(),
+            "words_in_grid": list(self.best_words),
+        }
@@ -1,20 +1,11 @@
 import random
 import time
 
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-def generate_random_possibility(words, dim):
-    """This function returns a randomly-generated possibility, instead of generating all
-    possible ones.
-    """
-    # Generate possibility
-    possibility = {
-        "word": words[random.randint(0, len(words) - 1)],
-        "location": [random.randint(0, dim[0] - 1), random.randint(0, dim[1] - 1)],
-        "D": "S" if random.random() > 0.5 else "E",
-    }
-
-    # Return it
-    return possibility
+from grid import BLANK, Grid, decode
+import metrics
 
 
 def is_within_bounds(word_len, line, column, direction, grid_width, grid_height):
@@ -26,19 +17,10 @@ def is_within_bounds(word_len, line, column, direction, grid_width, grid_height)
 
 def collides_with_existing_words(word, line, column, direction, grid):
     """Returns whether the given word collides with an existing one."""
-    for k, letter in enumerate(list(word)):
-        if direction == "E":
-            # Collisions
-            if grid[line][column + k] != 0 and grid[line][column + k] != letter:
-                return True
-        if direction == "S":
-            # Collisions
-            if grid[line + k][column] != 0 and grid[line + k][column] != letter:
-                return True
-
-    return False
+    return grid.collides(word, line, column, direction)
 
 
+@metrics.timed("validity_check")
 def ends_are_isolated(word, line, column, direction, grid):
     """Returns whether the given word is isolated (blank before start and after end)."""
     if direction == "E":
@@ -59,6 +41,64 @@ def ends_are_isolated(word, line, column, direction, grid):
     return True
 
 
+def filled_neighbours(word_len, line, column, direction, grid):
+    """Returns, for each cell of the word, whether any of the cells beside it
+    (across the word's direction) is filled.
+    """
+    neighbours = np.zeros(word_len, dtype=bool)
+
+    if direction == "E":
+        if line > 0:
+            neighbours |= grid.span(line - 1, column, "E", word_len) != BLANK
+        if line < grid.dimensions[0] - 1:
+            neighbours |= grid.span(line + 1, column, "E", word_len) != BLANK
+    if direction == "S":
+        if column > 0:
+            neighbours |= grid.span(line, column - 1, "S", word_len) != BLANK
+        if column < grid.dimensions[1] - 1:
+            neighbours |= grid.span(line, column + 1, "S", word_len) != BLANK
+
+    return neighbours
+
+
+def crossings(word_len, line, column, direction, grid):
+    """Returns the cells of a slot where a word would create a new word across it.
+
+    Each one is given as its position in the slot, the direction and location of
+    the new word, and the letters of the new word before and after the cell.
+    """
+    found = []
+
+    # The spaces that were originally blank and have adjacent letters
+    blank = grid.span(line, column, direction, word_len) == BLANK
+    touching = blank & filled_neighbours(word_len, line, column, direction, grid)
+
+    for k in np.flatnonzero(touching).tolist():
+        # Then we have to extract this new word, which goes across the given one
+        if direction == "E":
+            across = "S"
+            cell_line, cell_column = line, column + k
+            cells, position = grid.column(cell_column), cell_line
+        if direction == "S":
+            across = "E"
+            cell_line, cell_column = line + k, column
+            cells, position = grid.line(cell_line), cell_column
+
+        start, end = grid.run(cell_line, cell_column, across)
+        found.append(
+            (
+                k,
+                across,
+                [start, cell_column] if across == "S" else [cell_line, start],
+                decode(cells[start:position].tolist()),
+                decode(cells[position + 1 : end].tolist()),
+            )
+        )
+
+    return found
+
+
+@metrics.timed("find_new_words")
 def find_new_words(word, line, column, direction, grid, words):
     """Given a new potential word, looks for new words that might have been created by adding it to the grid.
 
@@ -66,74 +106,20 @@ def find_new_words(word, line, column, direction, grid, words):
     """
     new_words = []
 
-    for k, letter in enumerate(list(word)):
-        if direction == "E":
-            # If the space was originally blank and there are adjacent letters
-            if grid[line][column + k] == 0 and (
-                line > 0
-                and grid[line - 1][column + k] != 0
-                or line < len(grid) - 1
-                and grid[line + 1][column + k]
-            ):
-                # Then we have to extract this new word
-                poss_word = [letter]
-                l = 1
-                while line + l < len(grid[0]) and grid[line + l][column + k] != 0:
-                    poss_word.append(grid[line + l][column + k])
-                    l += 1
-                l = 1
-                while line - l > 0 and grid[line - l][column + k] != 0:
-                    poss_word.insert(0, grid[line - l][column + k])
-                    l += 1
-                poss_word = "".join(poss_word)
-
-                # And check if it exists in the list
-                if poss_word not in words:
-                    return None
-
-                new_words.append(
-                    {
-                        "D": "S",
-                        "word": poss_word,
-                        "location": [line - l + 1, column + k],
-                    }
-                )
+    for k, across, location, before, after in crossings(len(word), line, column, direction, grid):
+        poss_word = "".join(before + [word[k]] + after)
 
-        if direction == "S":
-            # If the space was originally blank and there are adjacent letter
-            if grid[line + k][column] == 0 and (
-                column > 0
-                and grid[line + k][column - 1] != 0
-                or column < len(grid[0]) - 1
-                and grid[line + k][column + 1]
-            ):
-                # Then we have to extract this new word
-                poss_word = [letter]
-                l = 1
-                while column + l < len(grid) and grid[line + k][column + l] != 0:
-                    poss_word.append(grid[line + k][column + l])
-                    l += 1
-                l = 1
-                while column - l > 0 and grid[line + k][column - l] != 0:
-                    poss_word.insert(0, grid[line + k][column - l])
-                    l += 1
-                poss_word = "".join(poss_word)
-
-                # And check if it exists in the list
-                if poss_word not in words:
-                    return None
-
-                new_words.append(
-                    {
-                        "D": "E",
-                        "word": poss_word,
-                        "location": [line + k, column - l + 1],
-                    }
-                )
+        # And check if it exists in the list
+        metrics.count("dictionary_membership")
+        if poss_word not in words:
+            return None
+
+        new_words.append({"D": across, "word": poss_word, "location": location})
 
     return new_words
 
 
+@metrics.timed("validity_check")
 def is_valid(possibility, grid, words):
     """This function determines whether a possibility is still valid in the
     given grid. (see generate_grid)
@@ -155,7 +141,7 @@ def is_valid(possibility, grid, words):
     D = possibility["D"]
 
     # Boundaries
-    if not is_within_bounds(len(word), i, j, D, len(grid[0]), len(grid)):
+    if not is_within_bounds(len(word), i, j, D, grid.dimensions[1], grid.dimensions[0]):
         return False
 
     # Collisions
@@ -170,8 +156,14 @@ def is_valid(possibility, grid, words):
     return True
 
 
+def score_bound(length, new_words):
+    """The score of a word of the given length that creates new_words new words.
+    Works on arrays as well."""
+    return length ** 2 + 10 * new_words
+
+
 def score_candidate(candidate_word, new_words):
-    return len(candidate_word) ** 2 + 10 * len(new_words)
+    return score_bound(len(candidate_word), len(new_words))
 
 
 def add_word_to_grid(possibility, grid):
@@ -183,15 +175,7 @@ def add_word_to_grid(possibility, grid):
     j = possibility["location"][1]
     word = possibility["word"]
 
-    # Word is left-to-right
-    if possibility["D"] == "E":
-        grid[i][j : len(list(word)) + j] = list(word)
-
-    # Word is top-to-bottom
-    # (I can't seem to be able to use the slicing as above)
-    if possibility["D"] == "S":
-        for index, a in enumerate(list(word)):
-            grid[i + index][j] = a
+    grid.place(word, i, j, possibility["D"])
 
 
 def select_candidate(candidates, scores):
@@ -203,7 +187,7 @@ def select_candidate(candidates, scores):
 
 
 def compute_occupancy(grid):
-    return 1 - (sum(x.count(0) for x in grid) / (len(grid[0]) * len(grid)))
+    return grid.occupancy()
 
 
 def create_empty_grid(dimensions):
@@ -212,48 +196,212 @@ def create_empty_grid(dimensions):
     dimensions[0] -> lines
     dimensions[1] -> columns
     """
-    return [x[:] for x in [[0] * dimensions[1]] * dimensions[0]]
+    return Grid(dimensions)
+
+
+def slot_pattern(line, column, direction, length, grid):
+    """Returns the cells a word of the given length would cover, with 0 for blank cells."""
+    return grid.letters(line, column, direction, length)
+
+
+def generate_slots(dim, rng=random):
+    """Returns every (line, column, direction) a word can start at, in random order."""
+    slots = [
+        (line, column, direction)
+        for line in range(dim[0])
+        for column in range(dim[1])
+        for direction in ("E", "S")
+    ]
+    rng.shuffle(slots)
 
+    return slots
 
-def generate_valid_candidates(grid, words, dim, timeout):
+
+@metrics.timed("generate_valid_candidates")
+def generate_valid_candidates(grid, words, dim, timeout, words_per_slot=50, rng=random, max_slots=None):
+    """Looks for a slot that can take a word and returns all the candidates for it.
+
+    Slots are visited in random order, and the dictionary's index gives every word
+    that fits the letters already in the slot, so no time is spent on words that collide.
+    The number of (slot, word) pairs that were tried is returned as well, and whether
+    the search was a full scan: every slot visited before the timeout, with every
+    word that fits it tried. Only an empty list from a full scan means no slot in the
+    grid can take any of the remaining words; at most words_per_slot words are tried
+    per slot, so a slot with more words may still take one of the others.
+
+    The number of slots that were visited is returned last. Given as max_slots, it
+    cuts the search at the same slot as the timeout did, so that a replay does
+    the same work as the recorded run.
+    """
     # Generate new candidates
     candidates = []
     scores = []
-    new_words = []
+    new_words_per_candidate = []
     tries = 0
+    full_scan = True
+    slots = 0
+    index = words.index
 
     start_time = time.time()
 
-    # Generate a new candidate
-    while not candidates and time.time() < start_time + timeout:
-        # Increment search "time"
-        tries += 1
+    for line, column, direction in generate_slots(dim, rng):
+        if candidates:
+            break
+        if max_slots is not None and slots >= max_slots or time.time() > start_time + timeout:
+            full_scan = False
+            break
+        slots += 1
+
+        for length in index.lengths():
+            # Boundaries
+            if not is_within_bounds(length, line, column, direction, dim[1], dim[0]):
+                continue
+
+            # Start and End
+            pattern = slot_pattern(line, column, direction, length, grid)
+            if not ends_are_isolated(pattern, line, column, direction, grid):
+                continue
+
+            # Every word returned by the index fits without collisions
+            found = index.find(pattern, limit=words_per_slot, rng=rng)
+            if len(found) >= words_per_slot:
+                full_scan = False
+            for word in found:
+                # Increment search "time"
+                tries += 1
+
+                # Find new words that this possibility generates
+                new_words = find_new_words(word, line, column, direction, grid, words)
+
+                # If new_words is None, then the possibility is invalid
+                if new_words is None:
+                    continue
+
+                # Add to list of candidates
+                candidates.append(
+                    {"word": word, "location": [line, column], "D": direction}
+                )
+                scores.append(score_candidate(word, new_words))
+                new_words_per_candidate.append(new_words)
+
+    metrics.count("candidates_tried", tries)
+    metrics.count("candidates_valid", len(candidates))
+
+    return candidates, scores, new_words_per_candidate, tries, full_scan, slots
 
-        # Get new possibility
-        new = generate_random_possibility(words, dim)
 
-        # Evaluate validity
-        if not is_valid(new, grid, words):
+@metrics.timed("score_slots")
+def score_slots(cells, lengths):
+    """Scores, in bulk, every slot that runs along the lines of the cells.
+
+    Returns the line, column, length and best possible score of every slot, of
+    every given length, whose ends are free, as arrays. The best possible score
+    assumes that every blank cell of the slot with a filled neighbour across it
+    starts a new word, which is the most it can do (see find_new_words).
+    Columns are scored by passing the transposed cells.
+    """
+    filled = cells != BLANK
+    n_columns = filled.shape[1]
+
+    # Blank cells with a filled cell above or below them
+    across = np.zeros_like(filled)
+    across[1:] |= filled[:-1]
+    across[:-1] |= filled[1:]
+    touching = across & ~filled
+
+    # With a free column on each side, so that the cells before and after a
+    # slot can be looked up without special cases at the edges
+    padded = np.pad(filled, ((0, 0), (1, 1)))
+
+    found = [[], [], [], []]
+    for length in lengths:
+        if length > n_columns:
             continue
+        starts = n_columns - length + 1
+
+        ends_free = ~padded[:, :starts] & ~padded[:, length + 1 : length + 1 + starts]
+        lines, columns = np.nonzero(ends_free)
+        touching_cells = sliding_window_view(touching, length, axis=1).sum(axis=2)
+
+        found[0].append(lines)
+        found[1].append(columns)
+        found[2].append(np.full(len(lines), length))
+        found[3].append(score_bound(length, touching_cells[lines, columns]))
+
+    if not found[0]:
+        return [np.zeros(0, dtype=int)] * 4
+    return [np.concatenate(part) for part in found]
+
+
+@metrics.timed("bulk_valid_candidates")
+def bulk_valid_candidates(grid, words, dim, timeout, rng=random, max_slots=None):
+    """Finds the best candidate over every slot of the grid.
+
+    Every slot is first scored in bulk (see score_slots), and the slots are then
+    visited from the best possible score down. Instead of checking the words of a
+    slot one by one, the letters that complete each crossing word are looked up
+    first, and the index only returns the words that have one of them at every
+    crossing (see WordIndex.match). Any such word creates a new word at every
+    crossing, so it reaches the best possible score of its slot, and the search
+    stops at the first slot that has one. Slots with the same possible score are
+    visited in random order. Returns the same as generate_valid_candidates; the
+    search is only cut short by the timeout, or by max_slots.
+    """
+    index = words.index
+    lengths = index.lengths()
 
-        # Find new words that this possibility generates
-        new_words = find_new_words(
-            new["word"], new["location"][0], new["location"][1], new["D"], grid, words
-        )
+    east = score_slots(grid.cells, lengths)
+    south = score_slots(grid.cells.T, lengths)
+    lines = np.concatenate([east[0], south[1]])
+    columns = np.concatenate([east[1], south[0]])
+    slot_lengths = np.concatenate([east[2], south[2]])
+    bounds = np.concatenate([east[3], south[3]])
+    directions = ["E"] * len(east[0]) + ["S"] * len(south[0])
+    metrics.count("slots_scored", len(bounds))
+
+    shuffled = np.random.default_rng(rng.randrange(2 ** 32)).permutation(len(bounds))
+    order = shuffled[np.argsort(-bounds[shuffled], kind="stable")]
+
+    candidates = []
+    scores = []
+    new_words_per_candidate = []
+    tries = 0
+    full_scan = True
+    slots = 0
 
-        # If new_words is None, then the possibility is invalid
-        if new_words == None:
-            new_words = []
+    start_time = time.time()
+
+    for k in order.tolist():
+        if max_slots is not None and slots >= max_slots or time.time() > start_time + timeout:
+            full_scan = False
+            break
+        slots += 1
+
+        line, column, length, direction = int(lines[k]), int(columns[k]), int(slot_lengths[k]), directions[k]
+        pattern = slot_pattern(line, column, direction, length, grid)
+        allowed = {}
+        for position, _, _, before, after in crossings(length, line, column, direction, grid):
+            allowed[position] = index.letters_at(before + [0] + after, len(before))
+
+        found = index.find(pattern, limit=1, rng=rng, allowed=allowed)
+        if not found:
             continue
 
-        # Calculate this possibility's score
-        score = score_candidate(new["word"], new_words)
+        word = found[0]
+        tries += 1
+        new_words = find_new_words(word, line, column, direction, grid, words)
+        if new_words is None:
+            continue
+
+        candidates.append({"word": word, "location": [line, column], "D": direction})
+        scores.append(score_candidate(word, new_words))
+        new_words_per_candidate.append(new_words)
+        break
 
-        # Add to list of candidates
-        candidates.append(new)
-        scores.append(score)
+    metrics.count("candidates_tried", tries)
+    metrics.count("candidates_valid", len(candidates))
 
-    return candidates, scores, new_words
+    return candidates, scores, new_words_per_candidate, tries, full_scan, slots
 
 
 def is_cell_free(line, col, grid):
@@ -261,14 +409,7 @@ def is_cell_free(line, col, grid):
 
     Does not throw if the indices are out of bounds. These cases return as free.
     """
-    # Negative indices are "legal", but we treat them as out of bounds.
-    if line < 0 or col < 0:
-        return True
-
-    try:
-        return grid[line][col] == 0
-    except IndexError:
-        return True
+    return grid.is_free(line, col)
 
 
 def is_isolated(possibility, grid):
@@ -287,57 +428,104 @@ def is_isolated(possibility, grid):
         return False
 
     # Look at the cells that surround the word
-    for i in range(len(word)):
-        if direction == "E":
-            if not is_cell_free(line - 1, column + i, grid) or not is_cell_free(
-                line + 1, column + i, grid
-            ):
-                return False
-        if direction == "S":
-            if not is_cell_free(line + i, column - 1, grid) or not is_cell_free(
-                line + i, column + 1, grid
-            ):
-                return False
+    if filled_neighbours(len(word), line, column, direction, grid).any():
+        return False
 
     # If nothing was found, then the word is isolated
     return True
 
 
-def basic_grid_fill(grid, occ_goal, timeout, dim, words):
+def basic_grid_fill(
+    grid,
+    occ_goal,
+    timeout,
+    dim,
+    words,
+    should_stop=None,
+    rng=random,
+    on_word_added=None,
+    bulk=False,
+    scans=None,
+    on_scan=None,
+):
     """Actually finds valid possibilities, scores them and adds them to the grid.
 
     Algorithm:
-    This function operates by taking the words it receives randomly generating possibilities
-    until a valid one is found. It is then added to the grid.
-    This is done until the grid is above a given completion level.
+    This function operates by picking random slots and looking up, in the word index,
+    every word that fits the letters already in the slot. The best of those is then
+    added to the grid.
+    This is done until the grid is above a given completion level, until the timeout,
+    or until a full scan of the grid finds no slot that can take any more words. If should_stop is given, it is called before every
+    new word, and the fill ends as soon as it returns True. If on_word_added is
+    given, it is called with every word that is added, the new words it created and
+    the number of candidates that were tried to find it.
+
+    With bulk set, every slot is scored at once and the best candidate of the whole
+    grid is added, instead of the best one of the first slot that takes any word
+    (see bulk_valid_candidates).
+
+    If on_scan is given, it is called with the number of slots every search
+    visited. Given those numbers back as scans, the n-th search stops after as
+    many slots as the n-th number instead of at its timeout, and the fill ends
+    once they are used up, so that a replay does exactly the work of the run.
+
+    All random choices are drawn from rng, so that a seeded rng gives a reproducible fill.
     """
     start_time = time.time()
     occupancy = 0
     added_words = []
+    tries = 0
+    if scans is not None:
+        scans = iter(scans)
 
     while occupancy < occ_goal and time.time() - start_time < timeout:
+        if should_stop and should_stop():
+            break
+
+        max_slots = None
+        if scans is not None:
+            max_slots = next(scans, None)
+            if max_slots is None:
+                break
+
         # Generate some candidates
         # This is limited to 1/10 of the total time we can use.
-        candidates, scores, new_words = generate_valid_candidates(
-            grid, words, dim, timeout / 10
-        )
+        if bulk:
+            candidates, scores, new_words_per_candidate, new_tries, full_scan, slots = bulk_valid_candidates(
+                grid, words, dim, timeout / 10, rng=rng, max_slots=max_slots
+            )
+        else:
+            candidates, scores, new_words_per_candidate, new_tries, full_scan, slots = generate_valid_candidates(
+                grid, words, dim, timeout / 10, rng=rng, max_slots=max_slots
+            )
+        tries += new_tries
+        if on_scan:
+            on_scan(slots)
 
-        # If there are no candidates, we move to the next iteration. This ensures that we can actually respect timeouts.
+        # Only a full scan that finds nothing means the grid is full. A search cut
+        # by its timeout or by sampling the words of a slot may find more next time.
         if not candidates:
+            if full_scan:
+                break
             continue
 
         # Select best candidate
         new, new_score = select_candidate(candidates, scores)
+        new_words = new_words_per_candidate[candidates.index(new)]
 
         # Add word to grid and to the list of added words
         add_word_to_grid(new, grid)
         added_words.append(new)
+        metrics.count("words_added")
+        if on_word_added:
+            on_word_added(new, new_words, tries)
+        tries = 0
 
         # Add new words to the words list
         for word in new_words:
             added_words.append(word)
 
-        # Remove words from list so we don't repeat ourselves
+        # Mark words as used so we don't repeat ourselves
         words.remove(new["word"])
         for word in new_words:
             words.remove(word["word"])
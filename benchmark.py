@@ -0,0 +1,427 @@
+#!/usr/bin/python3
+""" Benchmark
+
+Runs the grid generators, GridGenerator (basic_ops), BulkGridGenerator, ConstraintGenerator and
+korsord.rutnät.generera, over a matrix of grid sizes, word list sizes and seeds, and writes the results to
+a JSON file that can be compared with the results of another commit.
+
+Every run happens in a fresh process, so that caches don't carry over between
+runs and the peak memory of the process belongs to that run only. Unless a word
+file is given, the words are generated, so the benchmark runs offline.
+"""
+
+# Standard imports
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then left out
+    resource = None
+
+# The occupancies for which we record how long it took to reach them
+THRESHOLDS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+# The occupancy each engine is meant to reach. Runs record how far short of it
+# they fall, so that the gap can be followed from commit to commit.
+TARGETS = {"csp": 0.8}
+
+VOWELS = "AEIOUYÅÄÖ"
+# Korsord.starta picks a random ASCII letter, so every one of them must occur
+CONSONANTS = "BCDFGHJKLMNPQRSTVWXZ"
+LENGTHS = [3, 3, 4, 4, 4, 5, 5, 5, 6, 6, 7, 7, 8, 9, 10, 11]
+
+
+def parse_cmdline_args():
+    """Uses argparse to get commands line args."""
+    parser = argparse.ArgumentParser(description="Benchmark the grid generators.")
+    parser.add_argument(
+        "-e",
+        type=str,
+        nargs="+",
+        default=["basic", "bulk", "csp", "korsord"],
+        choices=["basic", "bulk", "csp", "korsord"],
+        dest="engines",
+        help="The generators to benchmark.",
+    )
+    parser.add_argument(
+        "-d",
+        type=int,
+        nargs="+",
+        default=[15, 25],
+        dest="sizes",
+        help="Sizes of the (square) grids to build.",
+    )
+    parser.add_argument(
+        "-n",
+        type=int,
+        nargs="+",
+        default=[2000, 20000],
+        dest="word_counts",
+        help="Sizes of the word lists to use.",
+    )
+    parser.add_argument(
+        "-s",
+        type=int,
+        nargs="+",
+        default=[1, 2, 3],
+        dest="seeds",
+        help="Seeds to run every combination with.",
+    )
+    parser.add_argument(
+        "-t",
+        type=float,
+        default=10,
+        dest="time_budget",
+        help="Time budget, in seconds, for each run.",
+    )
+    parser.add_argument(
+        "-f",
+        type=str,
+        default=None,
+        dest="word_file",
+        help="A file with one word per line. By default, words are generated.",
+    )
+    parser.add_argument(
+        "-o",
+        type=str,
+        default="benchmark.json",
+        dest="out_file",
+        help="Name of the output JSON file.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        nargs=2,
+        default=None,
+        metavar=("OLD", "NEW"),
+        help="Compare two result files instead of running the benchmark.",
+    )
+    parser.add_argument(
+        "--heuristic",
+        type=str,
+        default=None,
+        choices=["slumpad", "sällsynt", "frihet", "begränsning"],
+        dest="heuristic",
+        help="The order in which korsord tries crossings, see korsord.rutnät.HEURISTIKER.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        dest="stats",
+        help="Also collect the generators' counters and timers. This slows the runs down a bit.",
+    )
+
+    return parser.parse_args()
+
+
+def synthetic_words(count, seed):
+    """Generates pronounceable, uppercase words, so that the benchmark needs no word file."""
+    rng = random.Random(seed)
+    words = set()
+
+    while len(words) < count:
+        length = rng.choice(LENGTHS)
+        first = rng.random() < 0.5
+        words.add(
+            "".join(
+                rng.choice(CONSONANTS if (k % 2 == 0) == first else VOWELS)
+                for k in range(length)
+            )
+        )
+
+    return sorted(words)
+
+
+def load_words(word_file, count, seed):
+    """Returns count words, either from the given file or generated."""
+    if not word_file:
+        return synthetic_words(count, seed)
+
+    import file_ops
+
+    words = file_ops.read_word_list(word_file, case="upper")
+    random.Random(seed).shuffle(words)
+    return words[:count]
+
+
+def time_to_thresholds(timeline):
+    """Returns, for every threshold, the first time the occupancy reached it."""
+    reached = {}
+    for elapsed, occupancy in timeline:
+        for threshold in THRESHOLDS:
+            if occupancy >= threshold and str(threshold) not in reached:
+                reached[str(threshold)] = elapsed
+
+    return reached
+
+
+def run_generator(generator_class, words, size, seed, time_budget):
+    """Runs a generator and returns the timeline of occupancies and the candidates tried."""
+    n_loops = 3
+    generator = generator_class(words, [size, size], n_loops, time_budget / n_loops, 1.0, seed)
+
+    timeline = []
+    tries = [0]
+    start_time = time.perf_counter()
+
+    def on_word_added(new, new_words, new_tries):
+        tries[0] += new_tries
+        timeline.append((time.perf_counter() - start_time, generator.get_occupancy()))
+
+    generator.on_word_added = on_word_added
+    generator.generate_grid()
+
+    result = {
+        "timeline": timeline,
+        "placements": len(timeline),
+        "candidates": tries[0],
+        "occupancy": generator.get_occupancy(),
+    }
+    # ConstraintGenerator can't fill more than its templates cover, so that is tracked too
+    if hasattr(generator, "template_occupancy"):
+        result["template_occupancy"] = generator.template_occupancy
+
+    return result
+
+
+def run_basic(words, size, seed, time_budget):
+    from grid_generator import GridGenerator
+
+    return run_generator(GridGenerator, words, size, seed, time_budget)
+
+
+def run_bulk(words, size, seed, time_budget):
+    from grid_generator import BulkGridGenerator
+
+    return run_generator(BulkGridGenerator, words, size, seed, time_budget)
+
+
+def run_csp(words, size, seed, time_budget):
+    from constraint_generator import ConstraintGenerator
+
+    return run_generator(ConstraintGenerator, words, size, seed, time_budget)
+
+
+def run_korsord(words, size, seed, time_budget, heuristic=None):
+    """Runs korsord.rutnät.generera and returns the timeline of occupancies and the candidates tried."""
+    from rich import console
+    from korsord.rutnät import HEURISTIKER, Korsord, Ordlista, Ruta, generera
+
+    slump = random.Random(seed)
+
+    # Every 10th word is a special word, like the ones in feff.txt
+    ordlista = Ordlista(slump=slump).fyll(words[::10], words)
+    # Built in memory, so that every run pays for the index like a first start
+    ordlista.cache(katalog=None)
+
+    korsord = Korsord(
+        size,
+        size,
+        ordlista,
+        console.Console(quiet=True),
+        frö=seed,
+        slump=slump,
+        heuristik=HEURISTIKER[heuristic] if heuristic else None,
+    )
+    # Not used as a context manager, as __exit__ appends the grid to sparade.txt
+    korsord.__enter__()
+
+    def occupancy():
+        filled = sum(ruta is not Ruta.TOM for rad in korsord.rader() for ruta in rad)
+        return filled / (size * size)
+
+    timeline = []
+    start_time = time.perf_counter()
+
+    def efter_steg(korsord):
+        timeline.append((time.perf_counter() - start_time, occupancy()))
+
+    generera(korsord, tidsgräns=time_budget, efter_steg=efter_steg)
+
+    return {
+        "timeline": timeline,
+        "placements": len(korsord.ord),
+        "candidates": len(korsord.historik),
+        "occupancy": occupancy(),
+    }
+
+
+def run_case(engine, words, size, seed, time_budget, stats=False, heuristic=None):
+    """Runs one benchmark case. Meant to run in a fresh worker process."""
+    import metrics
+    from korsord import cachning, mätning
+
+    runner = {"basic": run_basic, "bulk": run_bulk, "csp": run_csp, "korsord": run_korsord}[engine]
+    # korsord has its own collector, with Swedish names
+    if stats and engine == "korsord":
+        mätning.aktivera()
+    elif stats:
+        metrics.enable()
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if engine == "korsord":
+            result = runner(words, size, seed, time_budget, heuristic)
+        else:
+            result = runner(words, size, seed, time_budget)
+    elapsed = time.perf_counter() - start_time
+
+    if stats and engine == "korsord":
+        result["stats"] = mätning.avaktivera().rapport()
+        result["stats"]["caches"] = cachning.rapport()
+    elif stats:
+        result["stats"] = metrics.disable().report()
+
+    timeline = result.pop("timeline")
+    result["time"] = elapsed
+    if engine in TARGETS:
+        result["target_occupancy"] = TARGETS[engine]
+        result["target_gap"] = TARGETS[engine] - result["occupancy"]
+    result["time_to_occupancy"] = time_to_thresholds(timeline)
+    result["placements_per_second"] = result["placements"] / elapsed
+    result["candidates_per_placement"] = (
+        result["candidates"] / result["placements"] if result["placements"] else None
+    )
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_memory_kb"] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+    )
+
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    runs = []
+    context = multiprocessing.get_context("spawn")
+
+    for word_count in args.word_counts:
+        words = load_words(args.word_file, word_count, seed=word_count)
+        for engine in args.engines:
+            for size in args.sizes:
+                for seed in args.seeds:
+                    case = {
+                        "engine": engine,
+                        "size": size,
+                        "words": len(words),
+                        "seed": seed,
+                    }
+                    print("Running {}...".format(case))
+
+                    with ProcessPoolExecutor(1, mp_context=context) as pool:
+                        result = pool.submit(
+                            run_case,
+                            engine,
+                            words,
+                            size,
+                            seed,
+                            args.time_budget,
+                            args.stats,
+                            args.heuristic,
+                        ).result()
+
+                    print(
+                        "  occupancy {:.3f}, {:.1f} placements/s, {} candidates/placement.".format(
+                            result["occupancy"],
+                            result["placements_per_second"],
+                            result["candidates_per_placement"],
+                        )
+                    )
+                    if "target_gap" in result:
+                        print(
+                            "  {:.3f} short of the {:.0%} target, templates cover {:.3f}.".format(
+                                result["target_gap"],
+                                result["target_occupancy"],
+                                result["template_occupancy"],
+                            )
+                        )
+                    runs.append({**case, **result})
+
+    return {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time_budget": args.time_budget,
+        "heuristic": args.heuristic,
+        "runs": runs,
+    }
+
+
+def compare(old_file, new_file):
+    """Prints the change in every metric between the runs of two result files."""
+    with open(old_file, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_file, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def key(run):
+        return run["engine"], run["size"], run["words"], run["seed"]
+
+    old_runs = {key(run): run for run in old["runs"]}
+    print("Comparing {} with {}:".format(old.get("commit"), new.get("commit")))
+
+    for run in new["runs"]:
+        before = old_runs.get(key(run))
+        if not before:
+            continue
+
+        print("{} {}x{}, {} words, seed {}:".format(run["engine"], run["size"], run["size"], run["words"], run["seed"]))
+        for metric in ["occupancy", "placements_per_second", "candidates_per_placement", "peak_memory_kb"]:
+            if before[metric] and run[metric] is not None:
+                print(
+                    "  {}: {:.4g} -> {:.4g} ({:+.1%})".format(
+                        metric, before[metric], run[metric], run[metric] / before[metric] - 1
+                    )
+                )
+        # Only recorded for some engines, and not by older commits
+        for metric in ["template_occupancy", "target_gap"]:
+            if before.get(metric) is not None and run.get(metric) is not None:
+                print("  {}: {:.3f} -> {:.3f}".format(metric, before[metric], run[metric]))
+        for threshold, elapsed in run["time_to_occupancy"].items():
+            if threshold in before["time_to_occupancy"]:
+                print(
+                    "  time to {}: {:.3f}s -> {:.3f}s".format(
+                        threshold, before["time_to_occupancy"][threshold], elapsed
+                    )
+                )
+
+
+def main():
+    # Parse args
+    args = parse_cmdline_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run_benchmark(args)
+
+    with open(args.out_file, "w", encoding="utf-8") as out_file:
+        json.dump(results, out_file, indent=1)
+    print("Wrote {} runs to {}.".format(len(results["runs"]), args.out_file))
+
+
+if __name__ == "__main__":
+    main()
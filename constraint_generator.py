@@ -0,0 +1,666 @@
+import math
+import random
+import time
+
+import basic_ops
+from anytime import Anytime
+from dictionary import Dictionary
+from grid import BLANK, BLOCK
+import metrics
+from recording import Recording
+
+# Cell type for any letter, in templates
+LETTER = 2
+
+# Number of changes tried on each template. Changes that don't lose any cells are kept.
+TEMPLATE_STEPS = 200
+
+# The search gives up on a slot after trying this many words for it
+MAX_WORDS_PER_SLOT = 100
+
+# A search that tries this many words without filling more cells starts over,
+# with the hardest slot left empty
+STALL_TRIES = 2000
+
+# Lengths with fewer words than this fraction of the most common length are not
+# used in templates, as slots of those lengths are too hard to fill.
+MIN_LENGTH_SHARE = 0.1
+
+
+def popcount(mask):
+    return bin(mask).count("1")
+
+
+def cell_types(size, words):
+    """Returns the type of each cell of a line (or column) with the given words,
+    as (start, length) pairs. Lengths include the ■ at both ends of the words.
+    """
+    types = [BLANK] * size
+    for start, length in words:
+        types[start] = types[start + length - 1] = BLOCK
+        types[start + 1 : start + length - 1] = [LETTER] * (length - 2)
+
+    return types
+
+
+def segment_line(size, lengths, weights, rng):
+    """Splits a line into words of random lengths, separated by single blank cells.
+
+    Returns the (start, length) of each word.
+    """
+    words = []
+    position = rng.randrange(2)
+
+    while True:
+        fitting = [k for k, length in enumerate(lengths) if position + length <= size]
+        if not fitting:
+            break
+
+        k = rng.choices(fitting, [weights[k] for k in fitting])[0]
+        words.append((position, lengths[k]))
+        position += lengths[k] + 1
+
+    return words
+
+
+def segment(forced, lengths, rng):
+    """Splits a line (or column) into words, agreeing with the cell types that
+    are already forced by the words that cross it (None for free cells).
+
+    Forced cells that can't be part of a word stand alone, with blank cells on
+    both sides. The segmentation with the most filled cells is returned, as the
+    number of filled cells and a list of (start, length) of each word.
+    """
+    size = len(forced)
+
+    def allows(cell, cell_type):
+        return forced[cell] is None or forced[cell] == cell_type
+
+    # How many cells, from each cell on, can hold letters
+    letter_run = [0] * (size + 1)
+    for cell in reversed(range(size)):
+        letter_run[cell] = letter_run[cell + 1] + 1 if allows(cell, LETTER) else 0
+
+    # best[cell] is the best (filled cells, words) for the cells from there on,
+    # given that the cell before is blank
+    best = [None] * (size + 2)
+    best[size] = best[size + 1] = (0, [])
+
+    def after(cell):
+        """The best way to go on after an item that ends just before cell."""
+        if cell >= size:
+            return (0, [])
+        if allows(cell, BLANK):
+            return best[cell + 1]
+        return None
+
+    for cell in reversed(range(size)):
+        options = []
+
+        if allows(cell, BLANK) and best[cell + 1] is not None:
+            options.append(best[cell + 1])
+
+        # A forced letter or block that stands alone
+        if forced[cell] in (LETTER, BLOCK):
+            rest = after(cell + 1)
+            if rest is not None:
+                options.append((rest[0] + 1, rest[1]))
+
+        if allows(cell, BLOCK):
+            for length in lengths:
+                end = cell + length - 1
+                if end >= size or letter_run[cell + 1] < length - 2:
+                    continue
+                if not allows(end, BLOCK):
+                    continue
+
+                rest = after(end + 1)
+                if rest is not None:
+                    options.append((rest[0] + length, [(cell, length)] + rest[1]))
+
+        if options:
+            most = max(option[0] for option in options)
+            best[cell] = rng.choice([option for option in options if option[0] == most])
+
+    return best[0]
+
+
+def segment_columns(dimensions, lines, lengths, rng):
+    """Splits every even column in the way that agrees with the given lines.
+
+    Returns the number of filled cells of the whole template and the words of
+    each column.
+    """
+    filled = sum(length for words in lines.values() for _, length in words)
+    line_types = {line: cell_types(dimensions[1], words) for line, words in lines.items()}
+    columns = {}
+
+    for column in range(0, dimensions[1], 2):
+        forced = [
+            line_types[line][column] if line in lines else None
+            for line in range(dimensions[0])
+        ]
+        _, columns[column] = segment(forced, lengths, rng)
+        # Cells on the lines are already counted
+        filled += sum(
+            1
+            for start, length in columns[column]
+            for line in range(start, start + length)
+            if line not in lines
+        )
+
+    return filled, columns
+
+
+def forced_by_columns(dimensions, columns, line):
+    """Returns the cell types that the words of the columns force on a line.
+
+    The cells just before and after a word must stay blank.
+    """
+    forced = [None] * dimensions[1]
+    for column, words in columns.items():
+        for start, length in words:
+            if start <= line < start + length:
+                forced[column] = BLOCK if line in (start, start + length - 1) else LETTER
+            elif line in (start - 1, start + length):
+                forced[column] = BLANK
+
+    return forced
+
+
+def generate_template(dimensions, lengths, weights, rng):
+    """Generates the slots of a grid, as {"location", "D", "length"} dicts.
+
+    Horizontal words go on even lines and vertical words on even columns, so words
+    only touch where they cross. A vertical word can only end where the lines leave
+    a block or a blank cell in its column, so the lines start out split at random
+    and are then improved: a vertical word is put somewhere at random, the lines it
+    crosses are split again around it, and the change is kept if the template
+    doesn't lose any cells.
+    """
+    lines = {
+        line: segment_line(dimensions[1], lengths, weights, rng)
+        for line in range(0, dimensions[0], 2)
+    }
+    filled, columns = segment_columns(dimensions, lines, lengths, rng)
+
+    fitting = [k for k, length in enumerate(lengths) if length <= dimensions[0]]
+
+    for _ in range(TEMPLATE_STEPS if fitting else 0):
+        length = lengths[rng.choices(fitting, [weights[k] for k in fitting])[0]]
+        column = rng.randrange(0, dimensions[1], 2)
+        start = rng.randrange(dimensions[0] - length + 1)
+
+        # Replace the words of the column that are in the way
+        changed_columns = dict(columns)
+        changed_columns[column] = [
+            (other, other_length)
+            for other, other_length in columns[column]
+            if other + other_length < start - 1 or other > start + length
+        ] + [(start, length)]
+
+        changed_lines = dict(lines)
+        for line in lines:
+            if start - 1 <= line <= start + length:
+                forced = forced_by_columns(dimensions, changed_columns, line)
+                _, changed_lines[line] = segment(forced, lengths, rng)
+
+        changed_filled, changed_columns = segment_columns(
+            dimensions, changed_lines, lengths, rng
+        )
+        if changed_filled >= filled:
+            lines, filled, columns = changed_lines, changed_filled, changed_columns
+
+    slots = []
+    for line, words in lines.items():
+        for start, length in words:
+            slots.append({"location": [line, start], "D": "E", "length": length})
+    for column, words in columns.items():
+        for start, length in words:
+            slots.append({"location": [start, column], "D": "S", "length": length})
+
+    return slots
+
+
+def slot_cells(slot, dimensions):
+    """Returns the index of every cell of a slot, in a flattened grid."""
+    line, column = slot["location"]
+    if slot["D"] == "E":
+        return [line * dimensions[1] + column + k for k in range(slot["length"])]
+    return [(line + k) * dimensions[1] + column for k in range(slot["length"])]
+
+
+def template_occupancy(slots, dimensions):
+    """Returns the share of the grid that a template covers, which is the most
+    occupancy a fill of it can reach."""
+    cells = {cell for slot in slots for cell in slot_cells(slot, dimensions)}
+    return len(cells) / (dimensions[0] * dimensions[1])
+
+
+def template_crossings(slots, dimensions):
+    """Returns, for each slot, the (position, other slot, other position) of
+    every letter it shares with another slot.
+    """
+    cells = {}
+    for s, slot in enumerate(slots):
+        for position, cell in enumerate(slot_cells(slot, dimensions)):
+            cells.setdefault(cell, []).append((s, position))
+
+    crossings = [[] for _ in slots]
+    for shared in cells.values():
+        if len(shared) != 2:
+            continue
+
+        (s, position), (t, other) = shared
+        # Shared blocks always agree
+        if position in (0, slots[s]["length"] - 1):
+            continue
+
+        crossings[s].append((position, t, other))
+        crossings[t].append((other, s, position))
+
+    return crossings
+
+
+def iterate_bits(mask, words, offset):
+    """Yields the words of the bits set in mask, starting at a given bit."""
+    for part, start in [(mask >> offset, offset), (mask & ((1 << offset) - 1), 0)]:
+        while part:
+            lowest = part & -part
+            yield words[start + lowest.bit_length() - 1]
+            part ^= lowest
+
+
+class ConstraintGenerator:
+    """Fills a template of slots as a constraint satisfaction problem.
+
+    Each slot's domain is a bitset from the word index. Assigning a word narrows
+    the domains of the slots that cross it (forward checking), and the narrowing is
+    carried on through the crossings (arc consistency), so dead ends are found
+    before they are reached. The slot with the smallest domain is filled first,
+    and when a slot runs out of words the search jumps back to the last slot that
+    caused the conflict, skipping the ones in between.
+
+    If time runs out, the best partial fill found so far is kept. Each loop fills
+    a new template, and the best grid over all loops is kept.
+
+    Since words only go on even lines and columns, templates cover less than 60% of a
+    15x15 grid (see template_occupancy), and the fill ends up a little below that.
+    """
+
+    def __init__(
+        self,
+        word_list,
+        dimensions,
+        n_loops,
+        timeout,
+        target_occupancy,
+        seed=None,
+        replay=None,
+    ):
+        self.dictionary = Dictionary(f"■{w}■" for w in word_list)
+        self.dimensions = dimensions
+        self.n_loops = n_loops
+        self.timeout = timeout
+        self.target_occupancy = target_occupancy
+        self.should_stop = None
+        self.on_word_added = None
+
+        # A time.monotonic() deadline for the whole run, and a callback that gets a
+        # snapshot of the best grid so far every snapshot_interval seconds
+        self.deadline = None
+        self.on_snapshot = None
+        self.snapshot_interval = 1.0
+        self.anytime = None
+        # The most cells any template of the run covered, as a share of the grid
+        self.template_occupancy = 0
+
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.replay = replay
+        self.recording = Recording(self.seed)
+        self.reset()
+
+    def get_grid(self):
+        return self.grid.to_lists()
+
+    def get_words_in_grid(self):
+        return self.words_in_grid
+
+    def get_occupancy(self):
+        return basic_ops.compute_occupancy(self.grid)
+
+    def get_recording(self):
+        return self.recording
+
+    def reset(self):
+        self.grid = basic_ops.create_empty_grid(self.dimensions)
+        self.words_in_grid = []
+        self.dictionary.reset()
+
+    def generate_grid(self):
+        """Updates the internal grid with content.
+
+        This is the main outward-facing function
+        """
+        self.reset()
+        self.recording = Recording(self.seed)
+        self.template_occupancy = 0
+        # A replay ignores the deadline, so that it places the same words
+        self.anytime = Anytime(
+            self.dimensions,
+            None if self.replay else self.deadline,
+            self.on_snapshot,
+            self.snapshot_interval,
+        )
+        print(
+            "Generating {} grid with {} words (seed {}).".format(
+                self.dimensions, len(self.dictionary), self.seed
+            )
+        )
+
+        # The grid is only ever replaced by a fuller one, so it is always the best so far
+        try:
+            for i in range(self.n_loops):
+                if self.replay:
+                    if i >= len(self.replay.loops):
+                        break
+                elif self.should_stop and self.should_stop():
+                    print("Stopping early.")
+                    break
+                elif self.anytime.expired():
+                    print("Deadline reached.")
+                    break
+                if self.get_occupancy() >= self.target_occupancy:
+                    break
+
+                print("Starting execution loop {}:".format(i + 1))
+                self.recording.start_loop()
+                self.fill_template(i)
+        except KeyboardInterrupt:
+            print("Interrupted, keeping the best grid so far.")
+
+        print("Built a grid of occupancy {}.".format(self.get_occupancy()))
+
+    def template_lengths(self):
+        """Returns the word lengths to use in templates, and how common they are."""
+        counts = {
+            length: len(words)
+            for length, words in self.dictionary.index.words.items()
+            if length >= 4
+        }
+        if not counts:
+            return [], []
+
+        most = max(counts.values())
+        lengths = sorted(l for l, n in counts.items() if n >= most * MIN_LENGTH_SHARE)
+
+        return lengths, [counts[l] for l in lengths]
+
+    def keep_if_better(self, slots, assignment):
+        """Replaces the grid with the given (partial) fill, if it is fuller."""
+        grid = basic_ops.create_empty_grid(self.dimensions)
+        words_in_grid = []
+        for s, word in assignment.items():
+            placement = {"word": word, "location": slots[s]["location"], "D": slots[s]["D"]}
+            basic_ops.add_word_to_grid(placement, grid)
+            words_in_grid.append(placement)
+
+        if basic_ops.compute_occupancy(grid) > self.get_occupancy():
+            self.grid = grid
+            self.words_in_grid = words_in_grid
+            self.anytime.offer(words_in_grid, self.get_occupancy())
+
+    def fill_template(self, loop=0):
+        """Generates a template and fills as much of it as possible.
+
+        When the search can't fill the template, the slot that failed most often is
+        left empty and the search starts over. Empty slots leave blank cells between
+        the words around them, so a template with fewer slots is still valid.
+        """
+        rng = random.Random("{}:{}".format(self.seed, loop))
+        lengths, weights = self.template_lengths()
+        if not lengths:
+            print("No words long enough to build a template.")
+            return
+
+        slots = generate_template(self.dimensions, lengths, weights, rng)
+        crossings = template_crossings(slots, self.dimensions)
+        coverage = template_occupancy(slots, self.dimensions)
+        self.template_occupancy = max(self.template_occupancy, coverage)
+        print(
+            "Filling a template of {} slots, occupancy {:2.3f}.".format(len(slots), coverage)
+        )
+
+        timeout = self.timeout
+        should_stop = self.should_stop
+
+        # When replaying, the loop ends after as many words as were recorded,
+        # instead of depending on how long the search takes
+        if self.replay:
+            timeout = math.inf
+
+            def should_stop():
+                placed = self.recording.placements_in_loop(loop)
+                return placed >= self.replay.placements_in_loop(loop)
+
+        start_time = time.time()
+
+        def stop():
+            return (
+                time.time() - start_time > timeout
+                or self.anytime.expired()
+                or (should_stop is not None and should_stop())
+                or self.get_occupancy() >= self.target_occupancy
+            )
+
+        active = set(range(len(slots)))
+        failures = [0] * len(slots)
+
+        while True:
+            outcome, filled_slots = self.search(
+                slots, crossings, active, failures, loop, rng, stop
+            )
+            if outcome != "failed" or not active:
+                break
+
+            hardest = max(sorted(active), key=lambda s: failures[s])
+            active.remove(hardest)
+            metrics.count("slots_dropped")
+
+        print(
+            "{} {} of {} slots, occupancy {:2.3f}.".format(
+                "Filled" if outcome == "complete" else "Stopped after filling",
+                filled_slots,
+                len(slots),
+                self.get_occupancy(),
+            )
+        )
+
+    @metrics.timed("constraint_search")
+    def search(self, slots, crossings, active, failures, loop, rng, stop):
+        """Conflict-directed backjumping search with forward checking and arc consistency,
+        over the active slots of a template.
+
+        Returns "complete" if every active slot was filled, "stopped" if stop() returned
+        True, or "failed" if the search ran out of words or stalled, along with the number
+        of slots that were filled at the end. Every slot whose words ran out gets a
+        failure counted in failures.
+        """
+        index = self.dictionary.index
+        cells = [slot_cells(slot, self.dimensions) for slot in slots]
+        lengths = [slot["length"] for slot in slots]
+        crossings = [
+            [crossing for crossing in crossings[s] if crossing[1] in active]
+            for s in range(len(slots))
+        ]
+
+        # The letters that can be at each position of each length, with their bitsets
+        letters_at = {}
+        for (length, position, letter), mask in index.masks.items():
+            letters_at.setdefault((length, position), []).append((letter, mask))
+
+        same_length = {}
+        for s in active:
+            same_length.setdefault(lengths[s], []).append(s)
+
+        domains = [index.available.get(length, 0) for length in lengths]
+        reasons = [frozenset() for _ in slots]  # the assigned slots that narrowed each domain
+        assignment = {}
+        covered = [0] * (self.dimensions[0] * self.dimensions[1])
+        filled = 0
+        best_filled = 0
+
+        # Visit slots with equal domains in a random order
+        order = sorted(active)
+        rng.shuffle(order)
+
+        def narrow(t, mask, why, trail, queue):
+            """Narrows a domain, remembering the old one. Returns the new domain."""
+            domain = domains[t] & mask
+            if domain != domains[t]:
+                trail.append((t, domains[t], reasons[t]))
+                domains[t] = domain
+                reasons[t] = reasons[t] | why
+                queue.append(t)
+            return domain
+
+        def propagate(s, word, trail):
+            """Narrows the domains after assigning word to s. Returns the slot whose
+            domain was wiped out, or None.
+            """
+            queue = []
+            why = frozenset([s])
+
+            # Forward checking on the crossing slots
+            for position, t, other in crossings[s]:
+                if t not in assignment:
+                    mask = index.masks.get((lengths[t], other, word[position]), 0)
+                    if not narrow(t, mask, why, trail, queue):
+                        return t
+
+            # A word is only used once
+            bit = index.bits[word]
+            for t in same_length[lengths[s]]:
+                if t not in assignment and domains[t] & bit:
+                    if not narrow(t, ~bit, why, trail, queue):
+                        return t
+
+            # Arc consistency between the slots that are still open
+            while queue:
+                t = queue.pop()
+                for position, u, other in crossings[t]:
+                    if u in assignment:
+                        continue
+
+                    support = 0
+                    for letter, mask in letters_at[(lengths[t], position)]:
+                        if domains[t] & mask:
+                            support |= index.masks.get((lengths[u], other, letter), 0)
+
+                    if not narrow(u, support, reasons[t], trail, queue):
+                        return u
+
+            return None
+
+        def undo(trail):
+            while trail:
+                t, domain, reason = trail.pop()
+                domains[t] = domain
+                reasons[t] = reason
+
+        def select():
+            """Returns the open slot with the fewest words left, or None."""
+            open_slots = [s for s in order if s not in assignment]
+            if not open_slots:
+                return None
+            return min(open_slots, key=lambda s: popcount(domains[s]))
+
+        def new_frame(s):
+            words = index.words[lengths[s]]
+            return {
+                "slot": s,
+                "values": iterate_bits(domains[s], words, rng.randrange(len(words))),
+                "tried": 0,
+                "conflicts": set(reasons[s]),
+                "trail": [],
+            }
+
+        def unassign(frame):
+            nonlocal filled
+            s = frame["slot"]
+            if s in assignment:
+                del assignment[s]
+                for cell in cells[s]:
+                    covered[cell] -= 1
+                    if not covered[cell]:
+                        filled -= 1
+            undo(frame["trail"])
+
+        stack = []
+        tries = 0
+        stalled = 0
+
+        while True:
+            if stop():
+                return "stopped", len(assignment)
+            if stalled > STALL_TRIES:
+                return "failed", len(assignment)
+
+            if not stack or stack[-1]["slot"] in assignment:
+                s = select()
+                if s is None:
+                    return "complete", len(assignment)
+                stack.append(new_frame(s))
+
+            frame = stack[-1]
+            s = frame["slot"]
+            word = None
+            if frame["tried"] < MAX_WORDS_PER_SLOT:
+                word = next(frame["values"], None)
+
+            if word is None:
+                # Out of words, jump back to the last slot in conflict with this one
+                failures[s] += 1
+                conflicts = frame["conflicts"] - {s}
+                stack.pop()
+                metrics.count("backjumps")
+                while stack and stack[-1]["slot"] not in conflicts:
+                    unassign(stack.pop())
+                if not stack:
+                    return "failed", len(assignment)
+
+                unassign(stack[-1])
+                stack[-1]["conflicts"] |= conflicts - {stack[-1]["slot"]}
+                continue
+
+            frame["tried"] += 1
+            tries += 1
+            stalled += 1
+            wiped = propagate(s, word, frame["trail"])
+            if wiped is not None:
+                metrics.count("wipeouts")
+                frame["conflicts"] |= reasons[wiped] - {s}
+                undo(frame["trail"])
+                continue
+
+            assignment[s] = word
+            for cell in cells[s]:
+                if not covered[cell]:
+                    filled += 1
+                covered[cell] += 1
+            metrics.count("assignments")
+
+            new = {"word": word, "location": slots[s]["location"], "D": slots[s]["D"]}
+            if self.replay:
+                self.replay.check(loop, self.recording.placements_in_loop(loop), new)
+            self.recording.record(new)
+
+            if filled > best_filled:
+                best_filled = filled
+                stalled = 0
+                self.keep_if_better(slots, assignment)
+
+            self.anytime.tick()
+            if self.on_word_added:
+                self.on_word_added(new, [], tries)
+            tries = 0
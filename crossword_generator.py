@@ -8,11 +8,28 @@ paper, if you're one of those people.
 
 # Standard imports
 import argparse
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Custom imports
 import file_ops
 import grid_generator
-from grid_generator import GridGenerator
+from constraint_generator import ConstraintGenerator
+from grid_generator import BulkGridGenerator, GridGenerator
+import metrics
+from recording import Recording
+
+ALGORITHM_CLASS_MAP = {
+    "basic": GridGenerator,
+    "bulk": BulkGridGenerator,
+    "csp": ConstraintGenerator,
+}
 
 
 def parse_cmdline_args():
@@ -21,9 +38,39 @@ def parse_cmdline_args():
     parser.add_argument(
         "-f",
         type=str,
-        default="words.txt",
+        nargs="+",
+        default=["words.txt"],
         dest="word_file",
-        help="A file containing words, one word per line.",
+        help="Files containing words, one word per line. Files ending in .gz or .xz are decompressed.",
+    )
+    parser.add_argument(
+        "--min-length",
+        type=int,
+        default=2,
+        dest="min_length",
+        help="Only use words longer than this.",
+    )
+    parser.add_argument(
+        "--max-length",
+        type=int,
+        default=None,
+        dest="max_length",
+        help="Only use words of at most this length.",
+    )
+    parser.add_argument(
+        "--alphabet",
+        type=str,
+        default=None,
+        dest="alphabet",
+        help="Only use words made of these letters, e.g. ABCDEFGHIJKLMNOPQRSTUVWXYZÅÄÖ.",
+    )
+    parser.add_argument(
+        "--case",
+        type=str,
+        default=None,
+        choices=["upper", "lower"],
+        dest="case",
+        help="Convert the words to upper or lower case before filtering them.",
     )
     parser.add_argument(
         "-d",
@@ -62,21 +109,140 @@ def parse_cmdline_args():
         help="Name of the output pdf file.",
     )
     parser.add_argument(
-        "-a", type=str, default="basic", dest="algorithm", help="The algorithm to use."
+        "--deadline",
+        type=float,
+        default=None,
+        dest="deadline",
+        help="Wall-clock budget, in seconds, for each grid. When it runs out, the best grid so far is returned.",
+    )
+    parser.add_argument(
+        "-a",
+        type=str,
+        default="basic",
+        dest="algorithm",
+        help="The algorithm to use: basic, bulk or csp.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        dest="workers",
+        help="Number of independent generators to run in parallel, one per process. The best grid is kept.",
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=1,
+        dest="count",
+        help="Number of grids to build. The words are loaded and indexed once, and shared by all the grids.",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=str,
+        default=None,
+        dest="out_dir",
+        help="Write every grid, with its seed and stats, to a JSON file in this directory, plus a summary.",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="json",
+        choices=["json", "binary"],
+        dest="out_format",
+        help="With --out-dir, write one JSON file per grid, or all the grids to one compact binary file.",
+    )
+    parser.add_argument(
+        "--pdf",
+        type=str,
+        default=None,
+        choices=["one", "each"],
+        dest="pdf",
+        help="With --out-dir, also render the grids to one multi-page PDF, or to one PDF per grid, compiled in parallel "
+        "by as many compilers as --workers, or one per CPU when it is 1.",
+    )
+    parser.add_argument(
+        "--latex-compiler",
+        type=str,
+        default=None,
+        dest="latex_compiler",
+        help="The command that compiles out.tex to out.pdf in its working directory. Default: pdflatex.",
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        default=None,
+        dest="json_file",
+        help="Write the grid, its words, seed and occupancy to this JSON file, which the papper frontend can load "
+        "if the grid is at most 21x21.",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=None,
+        dest="seed",
+        help="Seed for the random generator. With several workers, the workers' seeds are drawn from it.",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        dest="record_file",
+        help="Write the seed, settings and placements of the run to this file, so it can be replayed.",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        dest="replay_file",
+        help="Replay a recorded run exactly, e.g. under a profiler. Its settings override the other options.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        dest="stats",
+        help="Count and time the hot paths of the generator, and print a report at the end.",
     )
 
     return parser.parse_args()
 
 
+# The options that a recording needs to reproduce a run
+RECORDED_SETTINGS = [
+    "word_file",
+    "min_length",
+    "max_length",
+    "alphabet",
+    "case",
+    "dim",
+    "n_loops",
+    "timeout",
+    "target_occ",
+    "algorithm",
+]
+
+
 def create_generator(
-    algorithm, word_list, dimensions, n_loops, timeout, target_occupancy
+    algorithm,
+    word_list,
+    dimensions,
+    n_loops,
+    timeout,
+    target_occupancy,
+    seed=None,
+    replay=None,
 ):
     """Constructs the generator object for the given algorithm."""
-    algorithm_class_map = {"basic": GridGenerator}
-
     try:
-        return algorithm_class_map[algorithm](
-            word_list, dimensions, n_loops, timeout, target_occupancy
+        return ALGORITHM_CLASS_MAP[algorithm](
+            word_list,
+            dimensions,
+            n_loops,
+            timeout,
+            target_occupancy,
+            seed=seed,
+            replay=replay,
         )
     except KeyError:
         print(
@@ -86,30 +252,422 @@ def create_generator(
         )
 
 
+def generate_with_seed(
+    algorithm,
+    word_list,
+    dimensions,
+    n_loops,
+    timeout,
+    target_occupancy,
+    seed,
+    stop_event,
+    stats=False,
+    deadline=None,
+):
+    """Builds one grid with the given seed. Meant to run in a worker process.
+
+    The generator stops early once stop_event is set, and sets it itself when its
+    final grid, after culling, reaches the target occupancy.
+    """
+    if stats:
+        metrics.enable()
+
+    try:
+        generator = create_generator(
+            algorithm, word_list, dimensions, n_loops, timeout, target_occupancy, seed
+        )
+        generator.should_stop = stop_event.is_set
+        if deadline is not None:
+            generator.deadline = time.monotonic() + deadline
+
+        generator.generate_grid()
+
+        # Culling can take a grid back below the target, so the other workers are
+        # only stopped by a grid that still reaches it once it is final
+        occupancy = generator.get_occupancy()
+        if occupancy >= target_occupancy:
+            stop_event.set()
+
+        return {
+            "seed": seed,
+            "occupancy": occupancy,
+            "grid": generator.get_grid(),
+            "words_in_grid": generator.get_words_in_grid(),
+            "recording": generator.get_recording(),
+            "stats": metrics.report(),
+        }
+    finally:
+        # Pool processes are reused, so counters must not carry over to the next task
+        if stats:
+            metrics.disable()
+
+
+def generate_in_parallel(
+    algorithm,
+    word_list,
+    dimensions,
+    n_loops,
+    timeout,
+    target_occupancy,
+    workers,
+    seed=None,
+    stats=False,
+    deadline=None,
+):
+    """Runs independently seeded generators in a process pool.
+
+    Returns the result with the best occupancy, along with the seed and the
+    recording that reproduce it.
+    """
+    seed_generator = random.Random(seed)
+    seeds = [seed_generator.randrange(2 ** 32) for _ in range(workers)]
+    results = []
+
+    with multiprocessing.Manager() as manager:
+        stop_event = manager.Event()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    generate_with_seed,
+                    algorithm,
+                    word_list,
+                    dimensions,
+                    n_loops,
+                    timeout,
+                    target_occupancy,
+                    seed,
+                    stop_event,
+                    stats,
+                    deadline,
+                )
+                for seed in seeds
+            ]
+
+            for future in as_completed(futures):
+                result = future.result()
+                print(
+                    "Worker with seed {} built a grid of occupancy {:2.3f}.".format(
+                        result["seed"], result["occupancy"]
+                    )
+                )
+                results.append(result)
+
+    best = max(results, key=lambda result: result["occupancy"])
+    print(
+        "Best grid has occupancy {:2.3f}, from seed {}.".format(
+            best["occupancy"], best["seed"]
+        )
+    )
+
+    return best
+
+
+# The generator of a batch worker, built once by init_batch_worker
+batch_generator = None
+
+
+def init_batch_worker(
+    algorithm, word_list, dimensions, n_loops, timeout, target_occupancy
+):
+    """Builds the generator, and so the dictionary, that the worker reuses for every grid."""
+    global batch_generator
+    batch_generator = create_generator(
+        algorithm, word_list, dimensions, n_loops, timeout, target_occupancy
+    )
+
+
+def generate_batch_grid(seed, stats=False, deadline=None):
+    """Builds one grid of a batch with the worker's generator."""
+    if stats:
+        metrics.enable()
+
+    start_time = time.perf_counter()
+    batch_generator.seed = seed
+    if deadline is not None:
+        batch_generator.deadline = time.monotonic() + deadline
+    batch_generator.generate_grid()
+    recording = batch_generator.get_recording()
+
+    return {
+        "seed": seed,
+        "occupancy": batch_generator.get_occupancy(),
+        "time": time.perf_counter() - start_time,
+        "grid": batch_generator.get_grid(),
+        "words_in_grid": batch_generator.get_words_in_grid(),
+        "stats": metrics.disable().report() if stats else None,
+        "loops": recording.loops,
+        "scans": recording.scans,
+    }
+
+
+def summarize_batch(results, elapsed):
+    """Returns the throughput and the distribution of occupancies of a batch."""
+    occupancies = sorted(result["occupancy"] for result in results)
+    summary = {
+        "grids": len(results),
+        "seconds": elapsed,
+        "grids_per_minute": 60 * len(results) / elapsed if elapsed else None,
+        "occupancy": {
+            "min": occupancies[0],
+            "mean": statistics.mean(occupancies),
+            "median": statistics.median(occupancies),
+            "max": occupancies[-1],
+        },
+    }
+    if len(occupancies) > 1:
+        quartiles = statistics.quantiles(occupancies, n=4)
+        summary["occupancy"]["quartiles"] = quartiles
+        summary["occupancy"]["stdev"] = statistics.stdev(occupancies)
+
+    return summary
+
+
+def generate_batch(word_list, args, dimensions):
+    """Builds args.count grids, with seeds drawn from args.seed, and writes them out.
+
+    Every worker process builds its dictionary once, and reuses it for all of its
+    grids. Each grid is written to args.out_dir, if given, as a JSON file that
+    also works as a recording for --replay.
+    """
+    seed_generator = random.Random(args.seed)
+    seeds = [seed_generator.randrange(2 ** 32) for _ in range(args.count)]
+    settings = {setting: getattr(args, setting) for setting in RECORDED_SETTINGS}
+    generator_args = (
+        args.algorithm,
+        word_list,
+        dimensions,
+        args.n_loops,
+        args.timeout,
+        args.target_occ,
+    )
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    results = []
+    start_time = time.perf_counter()
+
+    def done(number, result):
+        print(
+            "Grid {}/{} (seed {}) has occupancy {:2.3f}, built in {:.1f}s.".format(
+                number, args.count, result["seed"], result["occupancy"], result["time"]
+            )
+        )
+        results.append(result)
+        if args.out_dir and args.out_format == "json":
+            # With the settings, loops and scans, the file also works as a recording
+            file_ops.write_grid_to_json(
+                os.path.join(args.out_dir, "grid-{:04d}.json".format(number)),
+                result["grid"],
+                result["words_in_grid"],
+                result["seed"],
+                {key: result[key] for key in ["occupancy", "time", "stats"]},
+                settings=settings,
+                loops=result["loops"],
+                scans=result["scans"],
+            )
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_batch_worker,
+            initargs=generator_args,
+        ) as pool:
+            futures = [
+                pool.submit(generate_batch_grid, seed, args.stats, args.deadline)
+                for seed in seeds
+            ]
+            for number, future in enumerate(as_completed(futures), start=1):
+                done(number, future.result())
+    else:
+        init_batch_worker(*generator_args)
+        for number, seed in enumerate(seeds, start=1):
+            done(number, generate_batch_grid(seed, args.stats, args.deadline))
+
+    summary = summarize_batch(results, time.perf_counter() - start_time)
+    print(
+        "Built {} grids in {:.1f}s, {:.1f} grids per minute.".format(
+            summary["grids"], summary["seconds"], summary["grids_per_minute"]
+        )
+    )
+    print(
+        "Occupancy: min {min:.3f}, median {median:.3f}, mean {mean:.3f}, max {max:.3f}.".format(
+            **summary["occupancy"]
+        )
+    )
+    if args.out_dir and args.pdf:
+        render_batch(results, args)
+    if args.out_dir and args.out_format == "binary":
+        file_ops.write_grids_to_binary(os.path.join(args.out_dir, "grids.bin"), results)
+    if args.out_dir:
+        with open(os.path.join(args.out_dir, "summary.json"), "w", encoding="utf-8") as summary_file:
+            json.dump(summary, summary_file, indent=1)
+
+    return results
+
+
+def render_batch(results, args):
+    """Renders the grids of a batch to PDF, skipping the files that are up to date."""
+    compiler = shlex.split(args.latex_compiler) if args.latex_compiler else None
+    grids = [
+        (result["grid"], [placed["word"].strip("■") for placed in result["words_in_grid"]])
+        for result in results
+    ]
+
+    if args.pdf == "one":
+        out_pdf = os.path.join(args.out_dir, "grids.pdf")
+        compiled = [file_ops.write_grids_to_pdf(grids, out_pdf, compiler)]
+    else:
+        # --workers is for the generators and defaults to 1, which would compile one at a time
+        workers = args.workers if args.workers > 1 else os.cpu_count()
+        compiled = file_ops.compile_latex_in_parallel(
+            [
+                (
+                    file_ops.latex_document([file_ops.grid_to_latex(grid, words)]),
+                    os.path.join(args.out_dir, "grid-{:04d}.pdf".format(number)),
+                )
+                for number, (grid, words) in enumerate(grids, start=1)
+            ],
+            compiler,
+            workers,
+        )
+    print(
+        "Rendered {} PDF files, {} were up to date.".format(
+            len(compiled), compiled.count(False)
+        )
+    )
+
+
+def save_recording(recording, args):
+    """Saves the recording of a run, if one was asked for."""
+    if not args.record_file:
+        return
+
+    recording.settings = {setting: getattr(args, setting) for setting in RECORDED_SETTINGS}
+    recording.save(args.record_file)
+    print("Recorded the run to {}.".format(args.record_file))
+
+
 def main():
     # Parse args
     args = parse_cmdline_args()
 
-    # Read words from file
-    words = file_ops.read_word_list(args.word_file)
-    print("Read {} words from file.".format(len(words)))
+    # A replay runs with the recorded settings, in a single process
+    replay = None
+    if args.replay_file:
+        replay = Recording.load(args.replay_file)
+        for setting, value in replay.settings.items():
+            setattr(args, setting, value)
+        args.seed = replay.seed
+        args.workers = 1
+        args.count = 1
+        args.out_dir = None
+        print("Replaying run with seed {}.".format(replay.seed))
+
+    # Words are streamed from the files, straight into the generator's dictionary
+    words = file_ops.iter_word_list(
+        args.word_file,
+        min_length=args.min_length,
+        max_length=args.max_length,
+        alphabet=args.alphabet,
+        case=args.case,
+    )
 
-    # Construct the generator object
     dim = args.dim if len(args.dim) == 2 else [args.dim[0], args.dim[0]]
+
+    writes_json = args.json_file or (args.out_dir and args.out_format == "json")
+    if writes_json and max(dim) > file_ops.PAPPER_SIZE:
+        print(
+            "The papper frontend shows grids of at most {}x{}, so the JSON files will have no squares.".format(
+                file_ops.PAPPER_SIZE, file_ops.PAPPER_SIZE
+            )
+        )
+
+    # Build many grids with the same words
+    if args.count > 1 or args.out_dir:
+        if args.algorithm not in ALGORITHM_CLASS_MAP:
+            print("Unknown algorithm: {}.".format(args.algorithm))
+            return
+
+        if args.workers > 1:
+            words = list(words)
+        generate_batch(words, args, dim)
+        return
+
+    # Run several generators at once and keep the best grid
+    if args.workers > 1:
+        if args.algorithm not in ALGORITHM_CLASS_MAP:
+            print("Unknown algorithm: {}.".format(args.algorithm))
+            return
+
+        # Every worker gets its own copy of the words
+        words = list(words)
+        print("Read {} words from file.".format(len(words)))
+
+        best = generate_in_parallel(
+            args.algorithm,
+            words,
+            dim,
+            args.n_loops,
+            args.timeout,
+            args.target_occ,
+            args.workers,
+            args.seed,
+            args.stats,
+            args.deadline,
+        )
+        save_recording(best["recording"], args)
+        if args.json_file:
+            file_ops.write_grid_to_json(
+                args.json_file,
+                best["grid"],
+                best["words_in_grid"],
+                best["seed"],
+                {"occupancy": best["occupancy"]},
+            )
+        file_ops.write_grid_to_screen(best["grid"], best["words_in_grid"])
+        if args.stats:
+            file_ops.write_stats_to_screen(best["stats"])
+        return
+
+    if args.stats:
+        metrics.enable()
+
+    # Construct the generator object
     generator = create_generator(
-        args.algorithm, words, dim, args.n_loops, args.timeout, args.target_occ
+        args.algorithm,
+        words,
+        dim,
+        args.n_loops,
+        args.timeout,
+        args.target_occ,
+        args.seed,
+        replay,
     )
     if not generator:
         return
+    if args.deadline is not None:
+        generator.deadline = time.monotonic() + args.deadline
 
     # Generate the grid
     generator.generate_grid()
+    save_recording(generator.get_recording(), args)
 
     # Write it out
     grid = generator.get_grid()
     words_in_grid = generator.get_words_in_grid()
     # file_ops.write_grid_to_file(grid, words=[x["word"] for x in words_in_grid], out_pdf=args.out_pdf)
+    if args.json_file:
+        file_ops.write_grid_to_json(
+            args.json_file,
+            grid,
+            words_in_grid,
+            generator.seed,
+            {"occupancy": generator.get_occupancy()},
+        )
     file_ops.write_grid_to_screen(grid, words_in_grid)
+    if args.stats:
+        file_ops.write_stats_to_screen(metrics.disable().report())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+from word_index import WordIndex
+
+
+class Dictionary:
+    """The words a generator can use, with O(1) membership checks and removal.
+
+    Words are split into available and used ones. Using a word only moves it from
+    one set to the other, so the dictionary can be restored between loops without
+    copying the word list. The word index is kept in step with the available words.
+    """
+
+    def __init__(self, words):
+        self.index = WordIndex(words)
+        self.available = set(self.index.bits)
+        self.used = set()
+
+    def __len__(self):
+        return len(self.available)
+
+    def __contains__(self, word):
+        """Returns whether the word can still be used."""
+        return word in self.available
+
+    def __iter__(self):
+        return iter(self.available)
+
+    def remove(self, word):
+        """Marks a word as used. Raises ValueError if it isn't available."""
+        if word not in self.available:
+            raise ValueError("Word is not available: {}.".format(word))
+
+        self.available.remove(word)
+        self.used.add(word)
+        self.index.remove(word)
+
+    def restore(self, word):
+        """Makes a used word available again."""
+        if word in self.used:
+            self.used.remove(word)
+            self.available.add(word)
+            self.index.restore(word)
+
+    def reset(self):
+        """Makes every used word available again."""
+        for word in list(self.used):
+            self.restore(word)
@@ -1,154 +1,418 @@
+import gzip
+import hashlib
+import json
+import lzma
 import os
 import pprint
 import shutil
+import struct
 import subprocess
 import tempfile
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
 from rich import console
+from rich.table import Table
+
+
+# Openers for compressed word lists, by file extension
+OPENERS = {".gz": gzip.open, ".xz": lzma.open}
+
+
+def open_word_file(filename):
+    """Opens a word file for reading text, decompressing it if its extension says so."""
+    opener = OPENERS.get(os.path.splitext(filename)[1], open)
+    return opener(filename, "rt", encoding="utf-8")
+
+
+def iter_word_list(
+    filenames,
+    min_length=2,
+    min_different_letters=2,
+    max_length=None,
+    alphabet=None,
+    case=None,
+):
+    """Yields the words of one or more files, one word per line, as they are read.
 
+    Every word is normalized to Unicode NFC, so that e.g. an a followed by a
+    combining ring is the same as the Swedish å, and then to upper or lower case
+    if case is "upper" or "lower". Words must be longer than min_length, have
+    more than min_different_letters different letters, be at most max_length
+    long and use only the letters of the alphabet, if given. Each word is
+    yielded once, the first time it is read.
 
-def read_word_list(filename, min_length=2, min_different_letters=2):
-    """This function reads the file and returns the words read. It expects a
-    file where each word is in a line.
+    Only the words already yielded are kept in memory, so the words can go
+    straight into a dictionary without building a list first.
     """
-    # Initialize words list
-    words = []
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    if alphabet is not None:
+        alphabet = set(unicodedata.normalize("NFC", alphabet))
+    seen = set()
+
+    for filename in filenames:
+        with open_word_file(filename) as words_file:
+            for line in words_file:
+                word = unicodedata.normalize("NFC", line.strip())
+                if case == "upper":
+                    word = word.upper()
+                elif case == "lower":
+                    word = word.lower()
+
+                if len(word) <= min_length or len(set(word)) <= min_different_letters:
+                    continue
+                if max_length is not None and len(word) > max_length:
+                    continue
+                if alphabet is not None and not alphabet.issuperset(word):
+                    continue
+                if word in seen:
+                    continue
+
+                seen.add(word)
+                yield word
+
+
+def read_word_list(filenames, min_length=2, min_different_letters=2, **filters):
+    """This function reads the files and returns the words read, as a list. It
+    expects files where each word is in a line. See iter_word_list for the
+    filters.
+    """
+    return list(
+        iter_word_list(filenames, min_length, min_different_letters, **filters)
+    )
 
-    # Get all the words
-    with open(filename, encoding="utf-8") as words_file:
-        for line in words_file:
-            word = line.strip()
-            if len(word) > min_length and len(set(word)) > min_different_letters:
-                words.append(word)
 
-    # and we're done
-    return words
+LATEX_PREAMBLE = r"""\documentclass[a4paper]{article}
+\usepackage[utf8]{inputenc}
+\usepackage[table]{xcolor}
+\usepackage{multicol}
+\usepackage{fullpage}
+\usepackage{graphicx}
+
+\begin{document}
+"""
+
+# The compiler command, to which the name of the .tex file is appended. Any
+# command that turns out.tex into out.pdf in its working directory will do.
+LATEX_COMPILER = ["pdflatex", "-interaction=nonstopmode", "-halt-on-error"]
+
+
+def latex_table(grid, solution):
+    """Returns the LaTeX table of the grid, with the letters if solution is set."""
+    parts = [r"\resizebox{\textwidth}{!}{", r"\begin{tabular}{|", "c|" * len(grid[0]), "}\n\\hline\n"]
+    for line in grid:
+        cells = []
+        for element in line:
+            if element == 0:
+                cells.append(r"\cellcolor{black}0")
+            elif solution:
+                cells.append(str(element))
+            else:
+                cells.append("")
+        parts.append(" & ".join(cells))
+        parts.append(r"\\ \hline" + "\n")
+    parts.append("\\end{tabular}\n}")
+
+    return "".join(parts)
+
+
+def grid_to_latex(grid, words=()):
+    """Returns the LaTeX body of one puzzle: the grid, the words used (if given),
+    and the solution on the next page."""
+    parts = [r"\section*{Challenge}" + "\n", latex_table(grid, False), "\n\n"]
+
+    if words:
+        parts.append(r"\section*{Words used for the problem}" + "\n")
+        # Write in several columns, sorted by size
+        parts.append(r"\begin{multicols}{4}" + "\n" + r"\noindent" + "\n")
+        for word in sorted(words, key=lambda word: (len(word), word[0])):
+            parts.append(word + r"\\" + "\n")
+        parts.append(r"\end{multicols}" + "\n")
+
+    parts.append(r"\newpage" + "\n" + r"\section*{Solution}" + "\n")
+    parts.append(latex_table(grid, True))
+
+    return "".join(parts)
+
+
+def latex_document(bodies):
+    """Returns a whole LaTeX document with the given puzzle bodies, one after the other."""
+    return (
+        LATEX_PREAMBLE
+        + ("\n" + r"\newpage" + "\n").join(bodies)
+        + "\n"
+        + r"\end{document}"
+        + "\n"
+    )
+
+
+def compile_latex(source, out_pdf, compiler=None):
+    """Compiles a LaTeX document to out_pdf, unless it is already compiled.
+
+    The compiler runs in its own temporary directory, given to it as its working
+    directory, so several documents can be compiled at once from different threads.
+    The hash of the source and the compiler is kept next to the PDF, and the
+    document is only compiled again if it changes. Returns whether it was compiled.
+    """
+    compiler = list(compiler or LATEX_COMPILER)
+    digest = hashlib.sha256(
+        json.dumps([compiler, source]).encode("utf-8")
+    ).hexdigest()
+    hash_file = out_pdf + ".sha256"
+
+    if os.path.exists(out_pdf) and os.path.exists(hash_file):
+        with open(hash_file, encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                return False
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "out.tex"), "w", encoding="utf-8") as texfile:
+            texfile.write(source)
+
+        subprocess.run(
+            compiler + ["out.tex"],
+            cwd=tmpdir,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        shutil.copy(os.path.join(tmpdir, "out.pdf"), out_pdf)
+
+    with open(hash_file, "w", encoding="utf-8") as f:
+        f.write(digest + "\n")
+
+    return True
+
+
+def compile_latex_in_parallel(jobs, compiler=None, workers=None):
+    """Compiles many (source, out_pdf) pairs at once, each with its own compiler
+    process. Returns, for every job, whether it was compiled (see compile_latex)."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(compile_latex, source, out_pdf, compiler)
+            for source, out_pdf in jobs
+        ]
+        return [future.result() for future in futures]
 
 
 def write_grid_to_file(
-    grid, out_file="table.tex", out_pdf="out.pdf", keep_tex=False, words=[]
+    grid, out_file="table.tex", out_pdf="out.pdf", keep_tex=False, words=[], compiler=None
 ):
-    """This function receives the generated grid and writes it to the file (or
-    to the screen, if that's what we want). The grid is expected to be a list
-    of lists, as used by the remaining functions.
+    """This function receives the generated grid and writes it to a PDF. The grid
+    is expected to be a list of lists, as used by the remaining functions.
 
     If a list of words is given, it is taken as the words used on the grid and
-    is printed as such.
+    is printed as such. The LaTeX source is only written to out_file if keep_tex
+    is set.
     """
-    # Print grid to the file and compile
-    with open(out_file, "w") as texfile:
-        # Write preamble
-        texfile.write("\documentclass[a4paper]{article}" + "\n")
-        texfile.write(r"\usepackage[utf8]{inputenc}" + "\n")
-        texfile.write(r"\usepackage[table]{xcolor}" + "\n")
-        texfile.write(r"\usepackage{multicol}" + "\n")
-        texfile.write(r"\usepackage{fullpage}" + "\n")
-        texfile.write(r"\usepackage{graphicx}" + "\n")
-        texfile.write("\n")
-        texfile.write(r"\begin{document}" + "\n")
-        texfile.write(r"\section*{Challenge}" + "\n")
-
-        # Resize box
-        texfile.write(r"\resizebox{\textwidth}{!}{")
-
-        # Write table environment and format
-        texfile.write(r"\begin{tabular}{|")
-        for i in range(len(grid[0])):
-            texfile.write(r"c|")
-        texfile.write("}\n\hline\n")
-
-        # Write actual table
-        for line in grid:
-            for index, element in enumerate(line):
-                if element == 0:
-                    texfile.write(r"\cellcolor{black}0")
-
-                # This feels a bit hacky, suggestions appreciated
-                if index != len(line) - 1:
-                    texfile.write(" & ")
-
-            texfile.write(r"\\ \hline" + "\n")
-
-        # End tabular environment
-        texfile.write("\end{tabular}\n")
-        texfile.write(r"}" + "\n\n")
-
-        # Write the words that were used
-        if words:
-            texfile.write(r"\section*{Words used for the problem}" + "\n")
-            # Write in several columns
-            texfile.write(r"\begin{multicols}{4}" + "\n")
-            texfile.write(r"\noindent" + "\n")
-            # Sort words by size
-            words.sort(key=lambda word: (len(word), word[0]))
-            # Write words
-            for word in words:
-                texfile.write(word + r"\\" + "\n")
-            # End multicolumn environment
-            texfile.write(r"\end{multicols}" + "\n")
-
-        # Page break and new section
-        texfile.write(r"\newpage" + "\n")
-        texfile.write(r"\section*{Solution}" + "\n")
-
-        # Write solution
-        # Resize box
-        texfile.write(r"\resizebox{\textwidth}{!}{")
-
-        # Write table environment and format
-        texfile.write(r"\begin{tabular}{|")
-        for i in range(len(grid[0])):
-            texfile.write(r"c|")
-        texfile.write("}\n\hline\n")
-
-        # Write actual table
-        for line in grid:
-            for index, element in enumerate(line):
-                if element == 0:
-                    texfile.write(r"\cellcolor{black}0")
-                else:
-                    texfile.write(str(element))
-                # This feels a bit hacky, suggestions appreciated
-                if index != len(line) - 1:
-                    texfile.write(" & ")
-
-            texfile.write(r"\\ \hline" + "\n")
-
-        # End tabular environment
-        texfile.write("\end{tabular}\n")
-        texfile.write(r"}")
-
-        # End document
-        texfile.write("\end{document}\n")
-
-    # Compile in a temp folder
-    # (inspired by https://stackoverflow.com/questions/19683123/compile-latex-from-python)
+    source = latex_document([grid_to_latex(grid, words)])
+    if keep_tex:
+        with open(out_file, "w", encoding="utf-8") as texfile:
+            texfile.write(source)
+
     print("\n=== Compiling the generated latex file! ===")
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # Save current directory
-        original_dir = os.getcwd()
+    compile_latex(source, out_pdf, compiler)
+    print("=== Done! ===\n")
 
-        # Copy the latex source to the temporary directory
-        shutil.copy(out_file, tmpdir)
 
-        # Move to the temp directory
-        os.chdir(tmpdir)
+def write_grids_to_pdf(grids, out_pdf, compiler=None):
+    """Writes many puzzles, given as (grid, words) pairs, to one multi-page PDF."""
+    return compile_latex(
+        latex_document([grid_to_latex(grid, words) for grid, words in grids]),
+        out_pdf,
+        compiler,
+    )
 
-        # Rename .tex file to generic name "out"
-        os.rename(out_file, "out.tex")
 
-        # Compile
-        proc = subprocess.call(["pdflatex", "out.tex"])
+# The papper frontend lays its squares out on a fixed grid of this size
+PAPPER_SIZE = 21
 
-        # Copy PDF back to the original directory
-        shutil.copy("out.pdf", original_dir + "/" + out_pdf)
+# Binary grid files start with this, and every grid in them is a record
+GRIDS_MAGIC = b"CWGRIDS1"
+GRID_HEADER = struct.Struct("<IdHHH")  # seed, occupancy, rows, columns, words
+WORD_HEADER = struct.Struct("<HHBB")  # row, column, direction, length in bytes
 
-        # Move back to the original directory
-        os.chdir(original_dir)
-    print("=== Done! ===\n")
 
-    # Remove tex file?
-    if not keep_tex:
-        os.remove(out_file)
+def grid_words(words_in_grid):
+    """Returns the placed words without their blocks, with the row and column of
+    their first letter and their direction ("across" or "down")."""
+    words = []
+    for placed in words_in_grid:
+        row, column = placed["location"]
+        word = placed["word"]
+        if word.startswith("■"):
+            if placed["D"] == "S":
+                row += 1
+            else:
+                column += 1
+        words.append(
+            {
+                "word": word.strip("■"),
+                "row": row,
+                "column": column,
+                "direction": "down" if placed["D"] == "S" else "across",
+            }
+        )
+
+    # Numbered in reading order, like the clues of a printed crossword
+    words.sort(key=lambda word: (word["row"], word["column"], word["direction"]))
+    starts = {}
+    for word in words:
+        word["number"] = starts.setdefault((word["row"], word["column"]), len(starts) + 1)
+
+    return words
+
+
+def grid_to_document(grid, words_in_grid, seed=None, metrics=None):
+    """Returns the grid as a JSON-serializable document.
+
+    Besides the cells and the words, the document has a "squares" list in the
+    format of the papper frontend, which can be loaded there as is. The frontend
+    lays its squares out on a fixed PAPPER_SIZE x PAPPER_SIZE grid, so smaller grids
+    are padded with blocked squares, and larger ones get no "squares" at all.
+    """
+    rows, columns = len(grid), len(grid[0])
+    words = grid_words(words_in_grid)
+    document = {
+        "seed": seed,
+        "metrics": metrics or {},
+        "rows": rows,
+        "columns": columns,
+        # One string per row, with a space for blank cells
+        "cells": ["".join(cell or " " for cell in line) for line in grid],
+        "words": words,
+    }
+    if rows > PAPPER_SIZE or columns > PAPPER_SIZE:
+        return document
+
+    numbers = {(word["row"], word["column"]): word["number"] for word in words}
+    squares = []
+    for row in range(PAPPER_SIZE):
+        for column in range(PAPPER_SIZE):
+            cell = grid[row][column] if row < rows and column < columns else 0
+            letter = cell.upper() if cell and cell != "■" else ""
+            squares.append(
+                {
+                    "key": len(squares),
+                    "clueNumber": numbers.get((row, column), 0),
+                    "blocked": not letter,
+                    "borderTop": False,
+                    "borderRight": True,
+                    "borderBottom": True,
+                    "borderLeft": False,
+                    "arrowRight": False,
+                    "arrowDown": False,
+                    "active": False,
+                    "horizonalClue": "",
+                    "verticalClue": "",
+                    "letter": letter,
+                }
+            )
+    document["squares"] = squares
+
+    return document
+
+
+def write_grid_to_json(out_file, grid, words_in_grid, seed=None, metrics=None, **extra):
+    """Writes the grid document (see grid_to_document) to a JSON file, in one write.
+
+    Any extra keys, e.g. the settings, loops and scans of a recording, are added to the
+    document.
+    """
+    document = grid_to_document(grid, words_in_grid, seed, metrics)
+    document.update(extra)
+    data = json.dumps(document, ensure_ascii=False, separators=(",", ":"))
+    with open(out_file, "w", encoding="utf-8") as json_file:
+        json_file.write(data)
+
+
+def pack_grid(grid, words_in_grid, seed, occupancy):
+    """Returns the compact binary record of a grid.
+
+    The record is a header (seed, occupancy and sizes), the cells as one UTF-8
+    string with a space for blank cells, and then each word's position,
+    direction and letters.
+    """
+    cells = "".join(cell or " " for line in grid for cell in line).encode("utf-8")
+    words = grid_words(words_in_grid)
+    parts = [
+        GRID_HEADER.pack(seed or 0, occupancy, len(grid), len(grid[0]), len(words)),
+        struct.pack("<I", len(cells)),
+        cells,
+    ]
+    for word in words:
+        letters = word["word"].encode("utf-8")
+        parts.append(
+            WORD_HEADER.pack(
+                word["row"], word["column"], word["direction"] == "down", len(letters)
+            )
+        )
+        parts.append(letters)
+
+    return b"".join(parts)
+
+
+def write_grids_to_binary(out_file, results):
+    """Writes many grids, e.g. a batch run's, to one binary file.
+
+    Each result is a dict with the "grid", "words_in_grid", "seed" and
+    "occupancy" of a grid. Every record is preceded by its length.
+    """
+    parts = [GRIDS_MAGIC]
+    for result in results:
+        record = pack_grid(
+            result["grid"], result["words_in_grid"], result["seed"], result["occupancy"]
+        )
+        parts.append(struct.pack("<I", len(record)))
+        parts.append(record)
+
+    with open(out_file, "wb") as binary_file:
+        binary_file.write(b"".join(parts))
+
+
+def read_grids_from_binary(in_file):
+    """Yields the grids of a file written by write_grids_to_binary, as dicts with
+    the seed, occupancy, grid (with 0 for blank cells) and words."""
+    with open(in_file, "rb") as binary_file:
+        data = binary_file.read()
+    if not data.startswith(GRIDS_MAGIC):
+        raise ValueError("Not a binary grid file: {}.".format(in_file))
+
+    position = len(GRIDS_MAGIC)
+    while position < len(data):
+        (length,) = struct.unpack_from("<I", data, position)
+        position += 4
+        end = position + length
+
+        seed, occupancy, rows, columns, n_words = GRID_HEADER.unpack_from(data, position)
+        position += GRID_HEADER.size
+        (cells_length,) = struct.unpack_from("<I", data, position)
+        position += 4
+        cells = data[position : position + cells_length].decode("utf-8")
+        position += cells_length
+
+        words = []
+        for _ in range(n_words):
+            row, column, down, letters_length = WORD_HEADER.unpack_from(data, position)
+            position += WORD_HEADER.size
+            words.append(
+                {
+                    "word": data[position : position + letters_length].decode("utf-8"),
+                    "row": row,
+                    "column": column,
+                    "direction": "down" if down else "across",
+                }
+            )
+            position += letters_length
+
+        grid = [
+            [cell if cell != " " else 0 for cell in cells[row * columns : (row + 1) * columns]]
+            for row in range(rows)
+        ]
+        yield {"seed": seed, "occupancy": occupancy, "grid": grid, "words": words}
+        position = end
 
 
 def write_grid_to_screen(grid, words_in_grid):
@@ -167,3 +431,30 @@ def write_grid_to_screen(grid, words_in_grid):
                 style="yellow bold" if element != "■" else "rgb(30,30,30)",
             )
         print()
+
+
+def write_stats_to_screen(report):
+    """Prints the counters and timers collected with metrics."""
+    c = console.Console()
+
+    timers = Table(title="Timers")
+    timers.add_column("Name")
+    timers.add_column("Calls", justify="right")
+    timers.add_column("Seconds", justify="right")
+    timers.add_column("µs per call", justify="right")
+    for name, timer in report["timers"].items():
+        timers.add_row(
+            name,
+            str(timer["calls"]),
+            "{:.3f}".format(timer["seconds"]),
+            "{:.1f}".format(1e6 * timer["seconds"] / timer["calls"]),
+        )
+
+    counters = Table(title="Counters")
+    counters.add_column("Name")
+    counters.add_column("Count", justify="right")
+    for name, count in report["counters"].items():
+        counters.add_row(name, str(count))
+
+    c.print(timers)
+    c.print(counters)
@@ -0,0 +1,142 @@
+import numpy as np
+
+BLANK = 0
+BLOCK = 1
+BLOCK_LETTER = "■"
+
+# Letters are encoded as small integers, shared by every grid in the process.
+# Code 0 is a blank cell and decodes back to 0, as in the list-of-lists grids.
+_letters = [0, BLOCK_LETTER]
+_codes = {BLOCK_LETTER: BLOCK}
+_encoded_words = {}
+
+
+def encode_letter(letter):
+    """Returns the code of a letter, assigning a new one if it hasn't been seen yet."""
+    code = _codes.get(letter)
+    if code is None:
+        code = len(_letters)
+        if code > np.iinfo(np.uint8).max:
+            raise ValueError("Too many different letters to encode: {}.".format(letter))
+        _letters.append(letter)
+        _codes[letter] = code
+
+    return code
+
+
+def encode(word):
+    """Returns the codes of the letters of a word, as an array."""
+    codes = _encoded_words.get(word)
+    if codes is None:
+        codes = np.array([encode_letter(letter) for letter in word], dtype=np.uint8)
+        _encoded_words[word] = codes
+
+    return codes
+
+
+def decode(codes):
+    """Returns the letters for a sequence of codes, with 0 for blank cells."""
+    return [_letters[code] for code in codes]
+
+
+class Grid:
+    """A crossword grid backed by a 2-D array of letter codes.
+
+    Lines come first, columns second, as in the list-of-lists grids.
+
+    The number of filled cells, in total and per line and column, is kept up to
+    date as words are placed, so occupancy never needs a full scan.
+    """
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.cells = np.zeros(dimensions, dtype=np.uint8)
+        self.filled = 0
+        self.line_counts = np.zeros(dimensions[0], dtype=np.int32)
+        self.column_counts = np.zeros(dimensions[1], dtype=np.int32)
+
+    def __len__(self):
+        return self.cells.shape[0]
+
+    def clear(self):
+        self.cells.fill(BLANK)
+        self.filled = 0
+        self.line_counts.fill(0)
+        self.column_counts.fill(0)
+
+    def line(self, line):
+        return self.cells[line, :]
+
+    def column(self, column):
+        return self.cells[:, column]
+
+    def span(self, line, column, direction, length):
+        """Returns a view of the cells a word of the given length would cover."""
+        if direction == "E":
+            return self.cells[line, column : column + length]
+        return self.cells[line : line + length, column]
+
+    def letters(self, line, column, direction, length):
+        """Returns the letters in a span, with 0 for blank cells."""
+        return decode(self.span(line, column, direction, length).tolist())
+
+    def is_free(self, line, column):
+        """Checks whether a cell is free. Cells out of bounds count as free."""
+        if not (0 <= line < self.cells.shape[0] and 0 <= column < self.cells.shape[1]):
+            return True
+        return self.cells[line, column] == BLANK
+
+    def collides(self, word, line, column, direction):
+        """Returns whether the word disagrees with any letter already in its span."""
+        span = self.span(line, column, direction, len(word))
+        return bool(np.any((span != BLANK) & (span != encode(word))))
+
+    def place(self, word, line, column, direction):
+        """Writes a word to the grid. The word is assumed to be within bounds."""
+        span = self.span(line, column, direction, len(word))
+        newly_filled = span == BLANK
+        span[:] = encode(word)
+
+        # Update the counters with the cells that were blank before
+        count = int(np.count_nonzero(newly_filled))
+        self.filled += count
+        if direction == "E":
+            self.line_counts[line] += count
+            self.column_counts[column : column + len(word)] += newly_filled
+        else:
+            self.column_counts[column] += count
+            self.line_counts[line : line + len(word)] += newly_filled
+
+    def run(self, line, column, direction):
+        """Returns the start and end (exclusive) of the run of filled cells that
+        goes through the given cell, ignoring the cell itself.
+        """
+        if direction == "E":
+            cells, position = self.cells[line, :], column
+        else:
+            cells, position = self.cells[:, column], line
+
+        blanks_before = np.flatnonzero(cells[:position] == BLANK)
+        blanks_after = np.flatnonzero(cells[position + 1 :] == BLANK)
+        start = blanks_before[-1] + 1 if len(blanks_before) else 0
+        end = position + 1 + blanks_after[0] if len(blanks_after) else len(cells)
+
+        return int(start), int(end)
+
+    def occupancy(self):
+        return self.filled / self.cells.size
+
+    def free_cells(self):
+        return self.cells.size - self.filled
+
+    def free_in_lines(self):
+        """Returns the number of free cells in each line."""
+        return self.dimensions[1] - self.line_counts
+
+    def free_in_columns(self):
+        """Returns the number of free cells in each column."""
+        return self.dimensions[0] - self.column_counts
+
+    def to_lists(self):
+        """Returns the grid as a list of lists, with 0 for blank cells."""
+        return [decode(line) for line in self.cells.tolist()]
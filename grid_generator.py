@@ -1,60 +1,195 @@
+import math
+import random
+
 import basic_ops
+from anytime import Anytime
+import metrics
+from dictionary import Dictionary
+from recording import Recording
 
 
 class GridGenerator:
-    def __init__(self, word_list, dimensions, n_loops, timeout, target_occupancy):
-        self.word_list = [f"■{w}■" for w in word_list]
+    # Whether to pick the best candidate of the whole grid at every step
+    bulk = False
+
+    def __init__(
+        self,
+        word_list,
+        dimensions,
+        n_loops,
+        timeout,
+        target_occupancy,
+        seed=None,
+        replay=None,
+    ):
+        self.dictionary = Dictionary(f"■{w}■" for w in word_list)
         self.dimensions = dimensions
         self.n_loops = n_loops
         self.timeout = timeout
         self.target_occupancy = target_occupancy
+        self.should_stop = None
+        self.on_word_added = None
+
+        # A time.monotonic() deadline for the whole run, and a callback that gets a
+        # snapshot of the best grid so far every snapshot_interval seconds
+        self.deadline = None
+        self.on_snapshot = None
+        self.snapshot_interval = 1.0
+        self.anytime = None
+        self.best_culled = (-1, [])
+
+        # Every loop draws from its own generator, seeded from this one
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.replay = replay
+        self.recording = Recording(self.seed)
         self.reset()
 
     def get_grid(self):
-        return self.grid
+        return self.grid.to_lists()
 
     def get_words_in_grid(self):
         return self.words_in_grid
 
+    def get_occupancy(self):
+        return basic_ops.compute_occupancy(self.grid)
+
+    def get_recording(self):
+        return self.recording
+
     def generate_grid(self):
         """Updates the internal grid with content.
 
         This is the main outward-facing function
         """
         self.reset()
+        self.recording = Recording(self.seed)
+        # The fullest grid seen after culling, as (occupancy, words)
+        self.best_culled = (-1, [])
+        # A replay ignores the deadline, so that it places the same words
+        self.anytime = Anytime(
+            self.dimensions,
+            None if self.replay else self.deadline,
+            self.on_snapshot,
+            self.snapshot_interval,
+        )
         print(
-            "Generating {} grid with {} words.".format(
-                self.dimensions, len(self.word_list)
+            "Generating {} grid with {} words (seed {}).".format(
+                self.dimensions, len(self.dictionary), self.seed
             )
         )
 
         # Fill it up with the recommended number of loops
-        for i in range(self.n_loops):
-            print("Starting execution loop {}:".format(i + 1))
-            self.generate_content_for_grid()
-
-            print("Culling isolated words.")
-            self.cull_isolated_words()
-            self.reset_grid_to_existing_words()
-
-        print(
-            "Built a grid of occupancy {}.".format(
-                basic_ops.compute_occupancy(self.grid)
-            )
-        )
+        try:
+            for i in range(self.n_loops):
+                if self.replay:
+                    if i >= len(self.replay.loops):
+                        break
+                elif self.should_stop and self.should_stop():
+                    print("Stopping early.")
+                    break
+                elif self.anytime.expired():
+                    print("Deadline reached.")
+                    break
+
+                print("Starting execution loop {}:".format(i + 1))
+                self.recording.start_loop()
+                self.generate_content_for_grid(i)
+
+                print("Culling isolated words.")
+                self.cull_isolated_words()
+                self.reset_grid_to_existing_words()
+                self.offer_culled()
+                self.anytime.offer(self.words_in_grid, self.get_occupancy())
+        except KeyboardInterrupt:
+            print("Interrupted, keeping the best grid so far.")
+
+        self.keep_best()
+        print("Built a grid of occupancy {}.".format(self.get_occupancy()))
+
+    def offer_culled(self):
+        """Keeps the current grid, which must be culled, if it is the fullest so far."""
+        occupancy = self.get_occupancy()
+        if occupancy > self.best_culled[0]:
+            self.best_culled = (occupancy, list(self.words_in_grid))
+
+    def keep_best(self):
+        """Goes back to the fullest culled grid of the run.
+
+        The anytime best grid may have been offered in the middle of a loop that was
+        cut short, before its isolated words were culled. It is rebuilt from its
+        words, culled, and only kept if it is still fuller than the best grid of the
+        loops that ran to the end. The dictionary is then made to match the grid.
+        """
+        self.words_in_grid = list(self.anytime.best_words)
+        self.reset_grid_to_existing_words()
+        self.cull_isolated_words()
+        self.reset_grid_to_existing_words()
+        self.offer_culled()
+
+        self.words_in_grid = list(self.best_culled[1])
+        self.reset_grid_to_existing_words()
+        self.sync_dictionary()
+
+    def sync_dictionary(self):
+        """Marks exactly the words in the grid as used."""
+        self.dictionary.reset()
+        for word in self.words_in_grid:
+            if word["word"] in self.dictionary:
+                self.dictionary.remove(word["word"])
 
     def reset(self):
         self.grid = basic_ops.create_empty_grid(self.dimensions)
         self.words_in_grid = []
+        self.dictionary.reset()
 
-    def generate_content_for_grid(self):
+    def generate_content_for_grid(self, loop=0):
         """Uses the basic fill algorithm to fill up the crossword grid."""
+        timeout = min(self.timeout, self.anytime.remaining())
+        outer_should_stop = self.should_stop
+
+        def should_stop():
+            return self.anytime.expired() or (
+                outer_should_stop is not None and outer_should_stop()
+            )
+
+        # When replaying, every search visits as many slots as it did in the recorded
+        # run, and the loop ends after the last one, instead of depending on how long
+        # the search takes. Older recordings without scans end after as many words.
+        scans = self.replay.scans_in_loop(loop) if self.replay else None
+        if self.replay:
+            timeout = math.inf
+            should_stop = None
+
+        if self.replay and scans is None:
+
+            def should_stop():
+                placed = self.recording.placements_in_loop(loop)
+                return placed >= self.replay.placements_in_loop(loop)
+
+        placed = list(self.words_in_grid)
+
+        def on_word_added(new, new_words, tries):
+            if self.replay:
+                self.replay.check(loop, self.recording.placements_in_loop(loop), new)
+            self.recording.record(new)
+            placed.append(new)
+            placed.extend(new_words)
+            self.anytime.offer(placed, self.get_occupancy())
+            if self.on_word_added:
+                self.on_word_added(new, new_words, tries)
+
         self.words_in_grid += basic_ops.basic_grid_fill(
             self.grid,
             self.target_occupancy,
-            self.timeout,
+            timeout,
             self.dimensions,
-            self.word_list,
+            self.dictionary,
+            should_stop,
+            random.Random("{}:{}".format(self.seed, loop)),
+            on_word_added,
+            self.bulk,
+            scans,
+            self.recording.record_scan,
         )
 
     def cull_isolated_words(self):
@@ -71,11 +206,20 @@ class GridGenerator:
         isolated_words = [w for w in isolated_words if len(w) < 4]
         for word in isolated_words:
             print("Culling word: {}.".format(word))
+            metrics.count("words_culled")
             self.words_in_grid.remove(word)
+            self.dictionary.restore(word["word"])
 
     def reset_grid_to_existing_words(self):
         """Resets the stored grid to the words in self.words_in_grid"""
-        self.grid = basic_ops.create_empty_grid(self.dimensions)
+        self.grid.clear()
 
         for word in self.words_in_grid:
             basic_ops.add_word_to_grid(word, self.grid)
+
+
+class BulkGridGenerator(GridGenerator):
+    """The basic generator, scoring every slot of the grid at every step and adding
+    the best candidate overall (see basic_ops.bulk_valid_candidates)."""
+
+    bulk = True
@@ -0,0 +1,150 @@
+"""Begränsade cachar med statistik, samlade i ett register
+
+Varje cache har en gräns i byte för sina nycklar och värden, kastar ut det som
+använts längst tillbaka när gränsen nås, och räknar träffar, missar och
+utkastningar. Cacharna hör till ett omfång: de i KORSORD gäller bara det
+korsord som byggs just nu och töms när det är klart, de i GLOBAL beror bara på
+ordlistan och får ligga kvar. töm() tömmer alla, och rapport() visar vilka
+cachar som lönar sig.
+"""
+from __future__ import annotations
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+import sys
+
+GLOBAL = "global"
+KORSORD = "korsord"
+
+_SAKNAS = object()
+
+
+def storlek(obj) -> int:
+    """Ungefärlig storlek i byte, med elementen i tupler och listor"""
+    byte = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        byte += sum(sys.getsizeof(element) for element in obj)
+    return byte
+
+
+class Cache:
+    def __init__(self, namn: str, max_byte: int, omfång: str = GLOBAL):
+        self.namn = namn
+        self.max_byte = max_byte
+        self.omfång = omfång
+        self.data: OrderedDict = OrderedDict()
+        self.byte = 0
+        self.träffar = 0
+        self.missar = 0
+        self.utkastade = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def hämta(self, nyckel):
+        """Värdet för nyckeln, eller _SAKNAS"""
+        värde = self.data.get(nyckel, _SAKNAS)
+        if värde is _SAKNAS:
+            self.missar += 1
+        else:
+            self.träffar += 1
+            self.data.move_to_end(nyckel)
+        return värde
+
+    def spara(self, nyckel, värde):
+        if nyckel in self.data:
+            return
+        self.data[nyckel] = värde
+        self.byte += storlek(nyckel) + storlek(värde)
+        while self.byte > self.max_byte and self.data:
+            gammal, gammalt = self.data.popitem(last=False)
+            self.byte -= storlek(gammal) + storlek(gammalt)
+            self.utkastade += 1
+
+    def töm(self):
+        self.data.clear()
+        self.byte = 0
+
+    def nollställ(self):
+        """Töm cachen och börja räkna om från noll"""
+        self.töm()
+        self.träffar = self.missar = self.utkastade = 0
+
+    def rapport(self) -> dict:
+        anrop = self.träffar + self.missar
+        return {
+            "omfång": self.omfång,
+            "poster": len(self.data),
+            "byte": self.byte,
+            "max_byte": self.max_byte,
+            "träffar": self.träffar,
+            "missar": self.missar,
+            "utkastade": self.utkastade,
+            "träffgrad": self.träffar / anrop if anrop else None,
+        }
+
+
+_register: dict[str, Cache] = {}
+
+
+def registrera(namn: str, max_byte: int, omfång: str = GLOBAL) -> Cache:
+    """Skapa en cache i registret, eller ge tillbaka den som redan heter så"""
+    if namn not in _register:
+        _register[namn] = Cache(namn, max_byte, omfång)
+    return _register[namn]
+
+
+def cachad(namn: str, max_byte: int, omfång: str = GLOBAL, nyckel=None):
+    """Dekorator som cachar funktionen i en registrerad cache
+
+    nyckel gör om argumenten till nyckeln, som standard är det argumenten själva.
+    En nyckel av värden i stället för objekt gör att cachen inte håller objekten
+    vid liv.
+    """
+    cache = registrera(namn, max_byte, omfång)
+
+    def dekorator(funktion):
+        @wraps(funktion)
+        def cachad_funktion(*args):
+            k = nyckel(*args) if nyckel else args
+            värde = cache.hämta(k)
+            if värde is _SAKNAS:
+                värde = funktion(*args)
+                cache.spara(k, värde)
+            return värde
+
+        cachad_funktion.cache = cache
+        return cachad_funktion
+
+    return dekorator
+
+
+def cachar(omfång: str = None) -> list[Cache]:
+    """Alla registrerade cachar, eller de i ett omfång"""
+    return [cache for cache in _register.values() if omfång is None or cache.omfång == omfång]
+
+
+def töm(omfång: str = None):
+    """Töm cacharna i omfånget, eller alla, men behåll statistiken"""
+    for cache in cachar(omfång):
+        cache.töm()
+
+
+def nollställ(omfång: str = None):
+    """Töm cacharna i omfånget, eller alla, och nollställ statistiken"""
+    for cache in cachar(omfång):
+        cache.nollställ()
+
+
+@contextmanager
+def avgränsat(omfång: str = KORSORD):
+    """Kontexthanterare som tömmer omfångets cachar när blocket är slut"""
+    try:
+        yield
+    finally:
+        töm(omfång)
+
+
+def rapport() -> dict:
+    """Statistiken för varje cache, sorterad efter namn"""
+    return {namn: _register[namn].rapport() for namn in sorted(_register)}
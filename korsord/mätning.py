@@ -0,0 +1,46 @@
+"""Räknare och tidtagning för de heta delarna av generatorerna
+
+Svenska namn på metrics, som mäter åt alla generatorer. Mätningen är avstängd
+tills aktivera() anropas, och rapporten har svenska nycklar.
+"""
+from __future__ import annotations
+
+import metrics
+from metrics import NULL_TIMER as AVSTÄNGD, Timer as Tidtagning
+
+räkna = metrics.count
+tid = metrics.timer
+tidtagen = metrics.timed
+
+
+def på_svenska(rapport: dict) -> dict:
+    """En rapport från metrics med svenska nycklar"""
+    return {
+        "räknare": rapport["counters"],
+        "tider": {
+            namn: {"sekunder": tid["seconds"], "anrop": tid["calls"]}
+            for namn, tid in rapport["timers"].items()
+        },
+    }
+
+
+class Mätare(metrics.Metrics):
+    def rapport(self) -> dict:
+        """Alla räknare och tider, sorterade efter namn"""
+        return på_svenska(self.report())
+
+
+def aktivera() -> Mätare:
+    """Starta mätningen med en ny, tom mätare"""
+    return metrics.enable(Mätare)
+
+
+def avaktivera() -> Mätare:
+    """Stäng av mätningen och returnera mätaren som användes"""
+    return metrics.disable()
+
+
+def rapport() -> dict:
+    """Rapporten från den aktiva mätaren, eller None om mätningen är avstängd"""
+    aktiv = metrics.report()
+    return på_svenska(aktiv) if aktiv is not None else None
@@ -0,0 +1,337 @@
+"""Kompakt index över en ordlista
+
+Alla ord ligger i en enda UTF-8-sträng, åtskilda av SLUT. Ovanpå den finns
+tabeller med heltal: orden i bokstavsordning, som ger exakta uppslag och
+prefix med binärsökning, alla suffix i bokstavsordning, som ger varje
+förekomst av en delsträng på samma sätt, och orden där en bokstav följs av en
+annan med ett visst mellanrum. Minnet växer linjärt med antalet bokstäver,
+och ingen fråga bygger mängder per bokstav. Varje ord kan dessutom ha ett
+märke, ett litet heltal som sparas med indexet.
+
+Ett byggt index sparas i KATALOG, i en fil som heter efter ett hashvärde av
+orden och märkena, eller av ordfilernas innehåll.
+Senare körningar med samma ord öppnar filen med mmap i stället för att bygga
+om indexet, så parallella processer delar samma sidor i minnet.
+"""
+from __future__ import annotations
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Iterator, Sequence
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from rich.progress import track
+
+# Mindre än alla bokstäver, så att ett kort suffix sorteras före de längre
+SLUT = b"\0"
+JOKER = "."
+
+KATALOG = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "korsord"
+
+VERSION = 2
+MAGI = b"ORDINDEX"
+# Magi, byteordning, version, antal ord, suffix, mellanrumsnycklar och
+# mellanrumsplatser, textens längd i byte och nyckeln filen sparades under
+HUVUD = struct.Struct("=8sIIIIIII32s")
+NYCKEL = 5  # pre, mellanrum, post, början och slut i mellanrumsplatserna
+
+
+def hashvärde(text: bytes) -> bytes:
+    return hashlib.sha256(text).digest()
+
+
+def avtryck(text: bytes, märken: Sequence[int] = None) -> bytes:
+    """Nyckeln för ett index byggt ur orden och märkena själva"""
+    return hashvärde(text + (array("I", märken).tobytes() if märken else b""))
+
+
+def filavtryck(filer: Sequence[os.PathLike]) -> bytes:
+    """Nyckeln för ett index byggt ur filerna, av deras innehåll
+
+    Varje fil hashas med sin längd först, så att gränsen mellan filerna räknas.
+    """
+    avtryck = hashlib.sha256()
+    for fil in filer:
+        with open(fil, "rb") as f:
+            data = f.read()
+        avtryck.update(struct.pack("=Q", len(data)))
+        avtryck.update(data)
+    return avtryck.digest()
+
+
+class Ordindex:
+    def __init__(
+        self,
+        text: bytes,
+        start: Sequence[int],
+        sorterade: Sequence[int],
+        suffix: Sequence[int],
+        mellanrumsindex: dict[tuple[str, int, str], Sequence[int]],
+        märken: Sequence[int] = None,
+    ):
+        self.text = text
+        self.start = start
+        self.sorterade = sorterade
+        self.suffix = suffix
+        self.mellanrumsindex = mellanrumsindex
+        self.märken = märken if märken is not None else array("I", [0]) * len(start)
+        # I en mappad fil börjar texten efter tabellerna
+        self.bas = 0
+
+    @classmethod
+    def ladda(cls, ord: list[str], katalog: Path = KATALOG, märken: Sequence[int] = None) -> Ordindex:
+        """Öppna det sparade indexet för orden, eller bygg och spara det
+
+        Utan katalog byggs indexet bara i minnet.
+        """
+        text = SLUT.join(rd.encode() for rd in ord) + SLUT
+        if katalog is None:
+            return cls.bygg(ord, text, märken)
+        return cls._ladda(katalog, avtryck(text, märken), lambda: cls.bygg(ord, text, märken))
+
+    @classmethod
+    def ladda_filer(
+        cls,
+        filer: Sequence[os.PathLike],
+        läs: Callable[[], tuple[list[str], Sequence[int]]],
+        katalog: Path = KATALOG,
+    ) -> Ordindex:
+        """Öppna det sparade indexet för filerna, eller läs dem och bygg det
+
+        läs ger orden och märkena ur filerna. Så länge ingen av filerna har ändrats
+        hashas de bara, och öppnas indexet utan att orden tolkas.
+        """
+        def bygg():
+            ord, märken = läs()
+            return cls.bygg(ord, märken=märken)
+
+        if katalog is None:
+            return bygg()
+        return cls._ladda(katalog, filavtryck(filer), bygg)
+
+    @classmethod
+    def _ladda(cls, katalog: Path, nyckel: bytes, bygg: Callable[[], Ordindex]) -> Ordindex:
+        sökväg = Path(katalog) / f"{nyckel.hex()[:32]}.idx"
+        if (index := cls.öppna(sökväg, nyckel)) is not None:
+            return index
+        index = bygg()
+        try:
+            index.spara(sökväg, nyckel)
+        except OSError:
+            pass
+        return index
+
+    @classmethod
+    def bygg(cls, ord: list[str], text: bytes = None, märken: Sequence[int] = None) -> Ordindex:
+        if text is None:
+            text = SLUT.join(rd.encode() for rd in ord) + SLUT
+
+        start = array("I")
+        pos = 0
+        hinkar = defaultdict(list)
+        mellanrum = defaultdict(lambda: array("I"))
+        for ix, rd in enumerate(track(ord, description="Bygger ordindex...")):
+            start.append(pos)
+            # Suffixen börjar på varje bokstav, inte på varje byte
+            for bks in rd:
+                hinkar[text[pos]].append(pos)
+                pos += len(bks.encode())
+            pos += len(SLUT)
+            for i, pre in enumerate(rd):
+                for j in range(i + 2, len(rd)):
+                    platser = mellanrum[pre, j - i - 1, rd[j]]
+                    if not platser or platser[-1] != ix:
+                        platser.append(ix)
+
+        sorterade = array("I", sorted(range(len(ord)), key=lambda i: (ord[i], i)))
+
+        # Suffixen sorteras hink för hink, så att bara en hinks nycklar finns samtidigt
+        suffix = array("I")
+        for bks in sorted(hinkar):
+            suffix.extend(sorted(hinkar.pop(bks), key=lambda p: text[p : text.find(SLUT, p)]))
+
+        märken = array("I", märken) if märken is not None else None
+        return cls(text, start, sorterade, suffix, dict(mellanrum), märken)
+
+    def spara(self, sökväg: Path, nyckel: bytes = None):
+        """Skriv indexet till en ny fil, som byter plats med den gamla först när den är klar
+
+        Nyckeln läggs i huvudet, som standard avtrycket av orden och märkena.
+        """
+        if nyckel is None:
+            nyckel = avtryck(self.text, self.märken)
+        nycklar, platser = array("I"), array("I")
+        for (pre, mellan, post), ix in sorted(self.mellanrumsindex.items()):
+            nycklar.extend([ord(pre), mellan, ord(post), len(platser), len(platser) + len(ix)])
+            platser.extend(ix)
+
+        sökväg = Path(sökväg)
+        sökväg.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=sökväg.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fil:
+                fil.write(
+                    HUVUD.pack(
+                        MAGI,
+                        1,
+                        VERSION,
+                        len(self.start),
+                        len(self.suffix),
+                        len(nycklar) // NYCKEL,
+                        len(platser),
+                        len(self.text),
+                        nyckel,
+                    )
+                )
+                for tabell in (self.start, self.sorterade, self.märken, self.suffix, nycklar, platser):
+                    fil.write(array("I", tabell).tobytes())
+                fil.write(self.text)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, sökväg)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def öppna(cls, sökväg: Path, väntat: bytes = None) -> Ordindex | None:
+        """Mappa en sparad fil, eller None om den saknas, är av fel version eller har en annan nyckel"""
+        try:
+            with open(sökväg, "rb") as fil:
+                data = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(data) < HUVUD.size:
+            return None
+
+        magi, ordning, version, antal, suffix, nycklar, platser, längd, nyckel = HUVUD.unpack_from(data)
+        storlek = HUVUD.size + 4 * (3 * antal + suffix + NYCKEL * nycklar + platser) + längd
+        if (magi, ordning, version) != (MAGI, 1, VERSION) or len(data) != storlek:
+            return None
+        if väntat is not None and nyckel != väntat:
+            return None
+
+        vy = memoryview(data)
+        pos = HUVUD.size
+        tabeller = []
+        for n in (antal, antal, antal, suffix, NYCKEL * nycklar, platser):
+            tabeller.append(vy[pos : pos + 4 * n].cast("I"))
+            pos += 4 * n
+        start, sorterade, märken, suffix, nycklar, platser = tabeller
+
+        mellanrumsindex = {}
+        for i in range(0, len(nycklar), NYCKEL):
+            pre, mellan, post, början, slut = nycklar[i : i + NYCKEL]
+            mellanrumsindex[chr(pre), mellan, chr(post)] = platser[början:slut]
+
+        index = cls(data, start, sorterade, suffix, mellanrumsindex, märken)
+        index.bas = pos
+        return index
+
+    def __len__(self):
+        return len(self.start)
+
+    def _bitar(self, pos: int, n: int) -> bytes:
+        return self.text[self.bas + pos : self.bas + pos + n]
+
+    def ord(self, i: int) -> str:
+        pos = self.bas + self.start[i]
+        return self.text[pos : self.text.find(SLUT, pos)].decode()
+
+    def märke(self, i: int) -> int:
+        return self.märken[i]
+
+    def id(self, pos: int) -> int:
+        """Ordet som byten på plats pos i texten hör till"""
+        return bisect_right(self.start, pos) - 1
+
+    def _intervall(self, tabell: Sequence[int], läge, sub: bytes) -> tuple[int, int]:
+        """De index i tabellen där texten på platsen läge(värde) börjar med sub"""
+        n = len(sub)
+        # Kan gå förbi SLUT in i nästa ord, men SLUT sorteras ändå först
+        lo, hi = 0, len(tabell)
+        while lo < hi:
+            mitt = (lo + hi) // 2
+            if self._bitar(läge(tabell[mitt]), n) < sub:
+                lo = mitt + 1
+            else:
+                hi = mitt
+        början, hi = lo, len(tabell)
+        while lo < hi:
+            mitt = (lo + hi) // 2
+            if self._bitar(läge(tabell[mitt]), n) <= sub:
+                lo = mitt + 1
+            else:
+                hi = mitt
+        return början, lo
+
+    def _ordstart(self, i: int) -> int:
+        return self.start[i]
+
+    @staticmethod
+    def _samma(pos: int) -> int:
+        return pos
+
+    def hitta(self, rd: str) -> int | None:
+        """Det första ordet i listan som är precis rd, eller None"""
+        sökt = rd.encode() + SLUT
+        början, slut = self._intervall(self.sorterade, self._ordstart, sökt)
+        return self.sorterade[början] if början < slut else None
+
+    def __contains__(self, rd: str) -> bool:
+        return self.hitta(rd) is not None
+
+    def prefix(self, pre: str) -> Iterator[int]:
+        """Orden som börjar med pre, i bokstavsordning"""
+        början, slut = self._intervall(self.sorterade, self._ordstart, pre.encode())
+        for ix in range(början, slut):
+            yield self.sorterade[ix]
+
+    def innehåller(self, sub: str) -> Iterator[int]:
+        """Orden som innehåller sub, en gång för varje förekomst"""
+        if not sub:
+            return
+        början, slut = self._intervall(self.suffix, self._samma, sub.encode())
+        for ix in range(början, slut):
+            yield self.id(self.suffix[ix])
+
+    def förekomster(self, sub: str) -> Iterator[tuple[int, int]]:
+        """Varje förekomst av sub, som par av ord och position i ordet"""
+        if not sub:
+            return
+        början, slut = self._intervall(self.suffix, self._samma, sub.encode())
+        for ix in range(början, slut):
+            pos = self.suffix[ix]
+            i = self.id(pos)
+            yield i, len(self._bitar(self.start[i], pos - self.start[i]).decode())
+
+    def mellanrum(self, pre: str, mellan: int, post: str) -> Sequence[int]:
+        """Orden där pre följs av post med precis mellan bokstäver emellan"""
+        return self.mellanrumsindex.get((pre, mellan, post), ())
+
+    def mönster(self, mönster: str) -> Iterator[int]:
+        """Orden som passar mönstret, där JOKER står för vilken bokstav som helst
+
+        Den längsta biten utan jokrar slås upp bland suffixen, och resten av
+        mönstret jämförs bokstav för bokstav.
+        """
+        bitar = mönster.split(JOKER)
+        längst = max(bitar, key=len)
+        if not längst:
+            for i in range(len(self)):
+                if len(self.ord(i)) == len(mönster):
+                    yield i
+            return
+        offset = mönster.index(längst)
+        for i, pos in self.förekomster(längst):
+            if pos != offset:
+                continue
+            rd = self.ord(i)
+            if len(rd) == len(mönster) and all(
+                m == JOKER or m == bks for m, bks in zip(mönster, rd)
+            ):
+                yield i
@@ -10,19 +10,32 @@ from rich.progress import track
 from rich.table import Table
 from rich import box, console, panel
 from rich import print
-from random import choice, random, randrange, sample
+from random import Random, randrange
 from collections import deque, defaultdict
 from itertools import takewhile, cycle
 from operator import attrgetter, itemgetter
+from array import array
 from statistics import mean
-from parse import search
+from typing import Callable, Iterator, Sequence
 import string
 import datetime
-from functools import lru_cache
+import time
+import json
 import re
 
+from korsord import cachning, mätning
+from korsord.ordindex import KATALOG, Ordindex
+
 install(show_locals=True)
 
+MB = 2 ** 20
+
+# Standardgränser för hantera_aparta
+REPARATIONSDJUP = 8
+REPARATIONSNODER = 400
+# Så många misslyckade biverkningar minns innan minnet töms
+MISSLYCKADE = 100000
+
 
 class Ruta(str, Enum):
     TOM = "□"
@@ -83,7 +96,12 @@ class Ord:
     post: bool
 
     def __post_init__(self):
-        self.ord = self.ord.strip(f"\n{Ruta.BLOCK} ")
+        self.ord = self.städa(self.ord)
+
+    @staticmethod
+    def städa(ord: str) -> str:
+        """Ordet utan radbrytningar, block och mellanslag runt omkring"""
+        return ord.strip(f"\n{Ruta.BLOCK} ")
 
     def __eq__(self, rd: Ord):
         return self.ord == rd.ord
@@ -94,7 +112,11 @@ class Ord:
     def __str__(self):
         return f"{Ruta.BLOCK if self.pre else ''}{self.ord}{Ruta.BLOCK if self.post else ''}"
 
-    @lru_cache(maxsize=3000)
+    @property
+    def nyckel(self) -> tuple:
+        """Ordet och dess läge, så att lägeskänsliga jämförelser kan slås upp i mängder"""
+        return self.ord, self.läge.x, self.läge.y, self.läge.z
+
     def __contains__(self, sub: str):
         return sub in str(self)
 
@@ -128,10 +150,8 @@ class Ord:
             return slice(self.läge.y, self.läge.y + len(self))
         return slice(self.läge.x, self.läge.x + (len(self)))
 
-    @property
-    def poäng(self):
-        import random 
-        seed = random.random()
+    def poäng(self, slump: Random):
+        seed = slump.random()
         poäng = seed * len(self) if not self.special else len(self)
         return poäng ** 3 if self.special else poäng
 
@@ -164,45 +184,143 @@ class Ord:
     def förekomst(self, bks: str) -> list[int]:
         return förekomst(str(self), bks)
 
-@lru_cache(maxsize=1000000)
+@cachning.cachad("förekomst", 16 * MB)
 def förekomst(rd: str, sub: str) -> list[int]:
     if rd == sub:
         return []
     st = [m.start() for m in re.finditer(sub, rd)]
     return st
 
+class Kanon(Sequence):
+    """Orden i indexets ordning, som blir Ord först när de läses
+
+    Ett ord byggs en gång, så samma plats ger alltid samma Ord.
+    """
+
+    def __init__(self, index: Ordindex):
+        self.index = index
+        self.ord: list[Ord | None] = [None] * len(index)
+
+    def __len__(self):
+        return len(self.ord)
+
+    def __getitem__(self, ix: int) -> Ord:
+        rd = self.ord[ix]
+        if rd is None:
+            rd = self.ord[ix] = Ord(self.index.ord(ix), None, bool(self.index.märke(ix)), False, False)
+        return rd
+
+
+class Rangordning(Sequence):
+    """Orden i kanon sorterade efter en nyckel, först när ordningen behövs"""
+
+    def __init__(self, kanon: Kanon, nyckel: Callable[[int], float]):
+        self.kanon = kanon
+        self.nyckel = nyckel
+        self._ordning = None
+
+    @property
+    def ordning(self) -> list[int]:
+        if self._ordning is None:
+            self._ordning = sorted(range(len(self.kanon)), key=self.nyckel, reverse=True)
+        return self._ordning
+
+    def __len__(self):
+        return len(self.kanon)
+
+    def __getitem__(self, ix: int) -> Ord:
+        return self.kanon[self.ordning[ix]]
+
+
 @dataclass(unsafe_hash=True)
 class Ordlista:
-    ord: list[Ord] = field(default_factory=list, compare=False)
-    index: dict[str, set[Ord]] = field(compare=False, repr=False, default=None)
-    omöjliga: list[str] = field(default_factory=list, compare=False)
-
-    @lru_cache(maxsize=100000)
+    # Orden efter poäng, som rangordna
+    ord: Sequence[Ord] = field(default=(), compare=False)
+    index: Ordindex = field(compare=False, repr=False, default=None)
+    # Orden i indexets ordning, som inte beror på rangordningen
+    kanon: Sequence[Ord] = field(default=(), compare=False, repr=False)
+    omöjliga: set[str] = field(default_factory=set, compare=False)
+    slump: Random = field(default_factory=Random, compare=False, repr=False)
+    # Ett slumptal per ord i kanon, för poängen i ord
+    lotter: array = field(default=None, compare=False, repr=False)
+    # Orden och märkena från fyll, tills indexet byggs
+    fyllda: tuple = field(default=None, compare=False, repr=False)
+
+    @mätning.tidtagen("ordlista.finns")
     def __contains__(self, ord: Ord) -> bool:
         """Ordet finns i ordlistan"""
-        return ord in self.ord
-
-    def ladda(self):
-        with resources.open_text("korsord", "feff.txt", "utf-8") as specialfil:
-            self.ord += [Ord(o.upper(), None, True, False, False) for o in specialfil.readlines() if o]
-        with resources.open_text("korsord", "words.txt", "utf-8") as vanligfil:
-            self.ord += [Ord(o, None, False, False, False) for o in vanligfil.readlines() if o]
-        self.ord = sorted(self.ord, key=attrgetter("poäng"), reverse=True)
-        self.index = defaultdict(set)
+        return ord.ord in self.index
+
+    def ladda(self, katalog: Path = KATALOG):
+        """Öppna indexet över ordfilerna, eller läs dem och bygg det
+
+        Indexet sparas under ett hashvärde av filernas innehåll. Så länge de inte
+        ändras hashas de bara, och inga Ord byggs förrän de behövs.
+        """
+        paket = resources.files("korsord")
+        specialfil, vanligfil = paket / "feff.txt", paket / "words.txt"
+
+        def läs():
+            with specialfil.open(encoding="utf-8") as fil:
+                special = fil.readlines()
+            with vanligfil.open(encoding="utf-8") as fil:
+                vanliga = fil.readlines()
+            return self.ordna(special, vanliga)
+
+        return self.använd(Ordindex.ladda_filer([specialfil, vanligfil], läs, katalog))
+
+    def fyll(self, special: list[str], vanliga: list[str]):
+        """Fyll ordlistan med specialord och vanliga ord, som indexeras av cache"""
+        self.fyllda = self.ordna(special, vanliga)
         return self
 
-    def cache(self):
-        bokstäver = (string.ascii_letters + "åäöé").upper()
-        for bks in track(bokstäver, description="Bygger cachce..."):
-            for rd in self.ord:
-                if rd.förekomst(bks):
-                    self.index[bks].add(rd)
-        
+    @staticmethod
+    def ordna(special: list[str], vanliga: list[str]) -> tuple[list[str], list[int]]:
+        """Orden och deras märken, 1 för specialord, i indexets ordning"""
+        par = sorted(
+            [(Ord.städa(o.upper()), 1) for o in special if o]
+            + [(Ord.städa(o), 0) for o in vanliga if o]
+        )
+        return [rd for rd, _ in par], [märke for _, märke in par]
+
+    def använd(self, index: Ordindex):
+        """Använd indexet, och dra slumptalen för ordens poäng
+
+        Slumptalen dras i indexets ordning, som rangordna gör, men orden
+        sorteras först när ord läses.
+        """
+        self.index = index
+        self.kanon = Kanon(index)
+        self.lotter = array("d", (self.slump.random() for _ in range(len(index))))
+        self.ord = Rangordning(self.kanon, self.poäng)
+        return self
+
+    def poäng(self, ix: int) -> float:
+        """Samma poäng som Ord.poäng, med ordets slumptal i lotter"""
+        längd = len(self.index.ord(ix))
+        if self.index.märke(ix):
+            return längd ** 3
+        return self.lotter[ix] * längd
+
+    def specialord(self) -> list[Ord]:
+        """Specialorden, i samma ordning som i ord"""
+        special = [ix for ix in range(len(self.kanon)) if self.index.märke(ix)]
+        return [self.kanon[ix] for ix in sorted(special, key=self.poäng, reverse=True)]
+
+    def rangordna(self, ord) -> list[Ord]:
+        """Sortera efter poäng, i en ordning som inte beror på mängdernas hashvärden"""
+        ord = sorted(ord, key=attrgetter("ord", "special"))
+        return sorted(ord, key=lambda o: o.poäng(self.slump), reverse=True)
+
+    def cache(self, katalog: Path = KATALOG):
+        """Öppna eller bygg indexet över orden från fyll, utan katalog bara i minnet"""
+        ord, märken = self.fyllda
+        self.fyllda = None
+        return self.använd(Ordindex.ladda(ord, katalog, märken))
+
 
     def __enter__(self):
-        self.ladda()
-        self.cache()
-        return self
+        return self.ladda()
 
     def __exit__(self, *args):
         # with Path("./omöjliga.txt").open(mode="w", encoding="utf-8") as omöjligfil:
@@ -211,8 +329,12 @@ class Ordlista:
         #        omöjligfil.write(omöjlig + "\n")
         pass
 
-    def __getitem__(self, ord: str) -> Ord:
-        return next(o for o in self.ord if o == ord)
+    def __getitem__(self, ord: str | Ord) -> Ord:
+        """Ett Ord med samma bokstäver"""
+        ix = self.index.hitta(getattr(ord, "ord", ord))
+        if ix is None:
+            raise KeyError(ord)
+        return self.kanon[ix]
 
     def __repr__(self) -> str:
         return f"<Ordlista med {len(self.ord)} ord>"
@@ -224,38 +346,40 @@ class Ordlista:
         return next(iter(self))
 
 
-    @lru_cache(maxsize=50000)
     def omöjligt(self, sub: str):
         return sub in self.omöjliga
 
+    @mätning.tidtagen("ordlista.mellanrum")
     def mellanrum(self, pre: str, post: str, fria: int) -> list[Ord]:
-        del_1 = self.index[pre]
-        del_2 = self.index[post]
-        med_i = del_1.intersection(del_2)
-        filtrerat = [rd for rd in med_i if fyller_mellanrum(pre, post, fria, rd.ord)]
-        return sorted(filtrerat, key=attrgetter("poäng"), reverse=True)
-
+        """Ord där pre följs av post, med mellan 1 och fria bokstäver emellan"""
+        träffar = {
+            self.kanon[ix]
+            for mellan in range(1, fria + 1)
+            for ix in self.index.mellanrum(pre, mellan, post)
+        }
+        return self.rangordna(träffar)
+
+    @mätning.tidtagen("ordlista.kompatibla")
     def kompatibla(self, sub: str) -> list[Ord]:
+        """Längre ord som innehåller sub"""
         if not isinstance(sub, str):
             raise ValueError
         if self.omöjligt(sub):
             return []
-        if cache := self.index[sub]:
-            return sorted(list(cache), key=attrgetter("poäng"), reverse=True)
-        bitar = set(self.index[sub[0]])
-        if not bitar:
-            return []
-        for bks in sub[1:]:
-            bitar = bitar.intersection(self.index[bks])
-            if not bitar:
-                return []
-        komp = [o for o in bitar if o.förekomst(sub)]
-        self.index[sub] = set(komp)
+        komp = {
+            self.kanon[ix]
+            for ix in self.index.innehåller(sub)
+            if len(self.kanon[ix].ord) != len(sub)
+        }
         if not komp and len(sub) < 5:
-            self.omöjliga.append(sub)
-        return sorted(komp, key=attrgetter("poäng"), reverse=True)
+            self.omöjliga.add(sub)
+        return self.rangordna(komp)
 
-@lru_cache(maxsize=200000)
+    def mönster(self, mönster: str) -> list[Ord]:
+        """Ord som passar mönstret, där en punkt står för vilken bokstav som helst"""
+        return self.rangordna({self.kanon[ix] for ix in self.index.mönster(mönster)})
+
+@cachning.cachad("ord_i_lista", 32 * MB, cachning.KORSORD)
 def ord_i_lista(rad: tuple) -> list[str]:
     split_på_tomma = "".join(rad).split(Ruta.TOM)
     if not any(split_på_tomma):
@@ -269,11 +393,88 @@ def ord_i_lista(rad: tuple) -> list[str]:
     rensad = [o for o in split_på_block if o and 1 < len(o)]
     return rensad
 
-@lru_cache(maxsize=1000000)
-def fyller_mellanrum(pre: str, post: str, fria: int, rd: str):
-    tomma = "{{w:.{antal}}}".format(antal=fria)
-    mtch = search(pre + tomma + post, rd)
-    return mtch is not None
+class Frihetskarta:
+    """De tomma rutorna i rad åt varje håll från varje ruta
+
+    Vågrätt räknas de i korsordets rader, som kan sticka ut till höger, och
+    lodrätt i kolumnerna. Korsord.uppdatera markerar raden och kolumnen för
+    varje ändrad ruta, och bara de räknas om, först när kartan läses.
+    """
+
+    def __init__(self, korsord: Korsord):
+        self.korsord = korsord
+        self.väst: list[list[int]] = [[] for _ in range(korsord.höjd)]
+        self.öst: list[list[int]] = [[] for _ in range(korsord.höjd)]
+        self.norr: list[list[int]] = [[] for _ in range(korsord.bredd)]
+        self.syd: list[list[int]] = [[] for _ in range(korsord.bredd)]
+        self.ändrade_rader = set(range(korsord.höjd))
+        self.ändrade_kolumner = set(range(korsord.bredd))
+
+    def ändrad(self, x: int, y: int):
+        self.ändrade_rader.add(x)
+        if y < self.korsord.bredd:
+            self.ändrade_kolumner.add(y)
+
+    @staticmethod
+    def löp(linje: list[str]) -> tuple[list[int], list[int]]:
+        """De tomma rutorna direkt före och direkt efter varje ruta i linjen"""
+        före, efter = [0] * len(linje), [0] * len(linje)
+        for i in range(1, len(linje)):
+            if linje[i - 1] is Ruta.TOM:
+                före[i] = före[i - 1] + 1
+        for i in range(len(linje) - 2, -1, -1):
+            if linje[i + 1] is Ruta.TOM:
+                efter[i] = efter[i + 1] + 1
+        return före, efter
+
+    def räkna_om(self):
+        for x in self.ändrade_rader:
+            self.väst[x], self.öst[x] = self.löp(self.korsord.celler[x])
+        for y in self.ändrade_kolumner:
+            self.norr[y], self.syd[y] = self.löp(self.korsord.kolumnceller[y])
+        self.ändrade_rader.clear()
+        self.ändrade_kolumner.clear()
+
+    def fria(self, riktning: str, x: int, y: int) -> int:
+        """De tomma rutorna åt n, e, s eller w från rutan, fram till en bokstav, ett block eller kanten"""
+        if self.ändrade_rader or self.ändrade_kolumner:
+            self.räkna_om()
+        if riktning == "w":
+            return self.väst[x][y]
+        if riktning == "e":
+            return self.öst[x][y]
+        if riktning == "n":
+            return self.norr[y][x]
+        return self.syd[y][x]
+
+
+@dataclass
+class Ram:
+    """En nivå i hantera_aparta: ordet som sattes och biverkningarna som ska lagas"""
+    ord: Ord
+    aparta: list[Ord]
+    djup: int
+    ix: int = 0
+    möjliga: Iterator[Ord] = None
+    nyckel: tuple = None
+    # Ordet som prövas just nu, och spårets kontrollpunkt innan det sattes
+    prövat: Ord = None
+    punkt: int = None
+    # En nivå under den här stoppades av djupgränsen, så ett misslyckande är inte säkert
+    avskuren: bool = False
+
+
+@dataclass
+class Reparation:
+    """Statistik för ett anrop av hantera_aparta"""
+    ord: str
+    lyckad: bool = False
+    noder: int = 0
+    djup: int = 0
+    minnesträffar: int = 0
+    avbruten: bool = False
+    sekunder: float = 0.0
+
 
 @dataclass(unsafe_hash=True)
 class Korsord:
@@ -284,6 +485,36 @@ class Korsord:
     ord: list[Ord] = field(default_factory=list, repr=False, compare=False)
     aparta: dict[Ord, list[Ord]] = field(default_factory=dict, repr=False, compare=False)
     kors: dict[Läge, Kors] = field(default_factory=dict, repr=False, compare=False)
+    frö: int = field(default=None, compare=False)
+    slump: Random = field(default=None, repr=False, compare=False)
+    historik: list[list] = field(default_factory=list, repr=False, compare=False)
+    facit: list[list] = field(default=None, repr=False, compare=False)
+    celler: list[list[str]] = field(default=None, init=False, repr=False, compare=False)
+    kolumnceller: list[list[str]] = field(default=None, init=False, repr=False, compare=False)
+    täckning: dict[tuple[int, int], tuple[list, list]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    friheter: Frihetskarta = field(default=None, init=False, repr=False, compare=False)
+    # Ordningen som korsen prövas i, högst värde först, se HEURISTIKER. Som
+    # standard sällsynt, som fyllde mest på provkörningarna
+    heuristik: Callable[[Kors], float] = field(default=None, repr=False, compare=False)
+    korskö: Korskö = field(default=None, init=False, repr=False, compare=False)
+    # Orden i den ordning de sattes, så att de kan ångras baklänges
+    spår: list[Ord] = field(default_factory=list, init=False, repr=False, compare=False)
+    # Gränser för hantera_aparta: hur djupt biverkningar av biverkningar lagas, och
+    # hur många ord som får prövas, innan ordet som orsakade dem ges upp
+    reparationsdjup: int = field(default=REPARATIONSDJUP, compare=False)
+    reparationsnoder: int = field(default=REPARATIONSNODER, compare=False)
+    reparationer: list[Reparation] = field(default_factory=list, init=False, repr=False, compare=False)
+    # Biverkningar som inte gick att laga, med raden eller kolumnen de låg i
+    misslyckade: set[tuple] = field(default_factory=set, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.frö is None:
+            self.frö = randrange(2 ** 32)
+        if self.slump is None:
+            self.slump = Random(self.frö)
+        self.måla_om()
 
     def __enter__(self):
         lägen = [
@@ -292,6 +523,7 @@ class Korsord:
         self.kors.update(
             {l: Kors(l, self, Riktning.INGA, {}) for l in track(lägen, description="Skapar kors...")}
         )
+        self.korskö = Korskö(self, self.heuristik or sällsynt, self.slump)
         self.starta()
         return self
 
@@ -299,6 +531,8 @@ class Korsord:
         with Path("./sparade.txt").open(mode="a", encoding="utf-8") as bank:
             bank.write(str(self))
             bank.write(f"\nPoäng: {self.poängräkning()}\n\n")
+        # Rader och mönster från det här korsordet hjälper inte nästa
+        cachning.töm(cachning.KORSORD)
 
     def rendera(self) -> list[str]:
         return [" ".join(rad) for rad in self.rader()]
@@ -306,28 +540,76 @@ class Korsord:
     def __str__(self) -> str:
         return "\n".join(self.rendera())
 
-    @lru_cache
-    def __rutnät(self, ord: tuple[Ord]) -> list[list[str]]:
-        """Tolka alla ord till rutnätet"""
-        nät = []
-        for r in range(self.höjd):
-            rad = [Ruta.TOM for k in range(self.bredd)]
-            ord = [o for o in self.ord if o.horisontellt and o.läge.x == r]
-            for o in ord:
-                rad[o.skiva()] = list(o)
-            nät.append(rad)
-        for y, k in enumerate(zip(*nät)):
-            kol = list(k)
-            ord = [o for o in self.ord if o.vertikalt and o.läge.y == y]
-            if not ord:
-                continue
-            for o in ord:
-                sk = o.skiva()
-                kol[sk] = list(o)
-                kol = kol[0 : self.höjd]
-            for x, bks in enumerate(kol):
-                nät[x][y] = bks
-        return nät
+    def måla_om(self):
+        """Bygg om rutnätet från alla ord"""
+        self.celler = [[Ruta.TOM] * self.bredd for _ in range(self.höjd)]
+        self.kolumnceller = [[Ruta.TOM] * self.höjd for _ in range(self.bredd)]
+        self.täckning = defaultdict(lambda: ([], []))
+        self.friheter = Frihetskarta(self)
+        if self.korskö is not None:
+            self.korskö.allt_ändrat()
+        for rd in self.ord:
+            self.måla(rd)
+
+    def rutor(self, rd: Ord) -> list[tuple[int, int, str]]:
+        """Rutorna som ordet täcker, med sina bokstäver
+
+        Vågräta ord får sticka ut till höger om rutnätet, lodräta klipps nedtill.
+        """
+        if rd.horisontellt:
+            if not rd.läge.x < self.höjd:
+                return []
+            return [(rd.läge.x, rd.läge.y + i, bks) for i, bks in enumerate(rd)]
+        return [
+            (rd.läge.x + i, rd.läge.y, bks)
+            for i, bks in enumerate(rd)
+            if rd.läge.x + i < self.höjd
+        ]
+
+    def måla(self, rd: Ord):
+        """Lägg till ordet i rutorna det täcker"""
+        z = int(rd.vertikalt)
+        for x, y, bks in self.rutor(rd):
+            self.täckning[x, y][z].append((rd, bks))
+            self.uppdatera(x, y)
+
+    def sudda(self, rd: Ord):
+        """Ta bort ordet ur rutorna det täcker"""
+        z = int(rd.vertikalt)
+        for x, y, bks in self.rutor(rd):
+            täcker = self.täckning[x, y][z]
+            täcker.pop(next(i for i, (o, _) in enumerate(täcker) if o is rd))
+            self.uppdatera(x, y)
+        if not z:
+            rad = self.celler[rd.läge.x] if rd.läge.x < self.höjd else []
+            while len(rad) > self.bredd and not self.täckning[rd.läge.x, len(rad) - 1][0]:
+                rad.pop()
+
+    def uppdatera(self, x: int, y: int):
+        """Lodräta ord går före vågräta, och senare ord före tidigare"""
+        horisontella, vertikala = self.täckning[x, y]
+        if vertikala:
+            bks = vertikala[-1][1]
+        elif horisontella:
+            bks = horisontella[-1][1]
+        else:
+            bks = Ruta.TOM
+        rad = self.celler[x]
+        if y == len(rad):
+            rad.append(bks)
+        rad[y] = bks
+        if y < self.bredd:
+            self.kolumnceller[y][x] = bks
+        self.friheter.ändrad(x, y)
+        if self.korskö is not None:
+            self.korskö.ändrad(x, y)
+
+    def stäng(self, rd: Ord, post=False):
+        """Stäng ett ord som redan ligger i rutnätet"""
+        före = (rd.läge, rd.pre, rd.post)
+        rd.stäng(post=post)
+        if (rd.läge, rd.pre, rd.post) != före:
+            self.måla_om()
 
     def __getitem__(self, skiva: slice) -> str:
         return self.kors[Läge(skiva.start, skiva.stop, 0)]
@@ -349,12 +631,12 @@ class Korsord:
 
     
     def rader(self) -> list[list[str]]:
-        """Skapa rader"""
-        return self.__rutnät(tuple(self.ord))
+        """Raderna, som uppdateras på plats när ord sätts och ångras"""
+        return self.celler
     
     def kolumner(self) -> list[list[str]]:
-        """Rotera rader till kolumner"""
-        return list(zip(*self.rader()))
+        """Kolumnerna, som uppdateras på plats när ord sätts och ångras"""
+        return self.kolumnceller
 
     def hitta(self, bks: str) -> list[tuple[int, int]]:
         """Se alla koordinater för en viss bokstav"""
@@ -369,85 +651,127 @@ class Korsord:
         ]
 
 
-    def horisontella_ord(self) -> list[Ord]:
-        """Alla ord som bildas längsmed rader"""
-
-        def lg(ix, o):
-            lg = Läge(ix, max(0, "".join(self.rad(ix)).find(o)), 0)
-            if lg is None:
-                raise ValueError
-            return lg 
+    def ord_i_rad(self, ix: int) -> list[Ord]:
+        """Alla ord som bildas längsmed raden
 
-        rds = [
-            Ord(o, lg(ix, o), False, False, False)
-            for ix, rad in enumerate(self.rader())
+        Läget är där ordet först förekommer i raden.
+        """
+        rad = self.celler[ix]
+        text = "".join(rad)
+        return [
+            Ord(o, Läge(ix, max(0, text.find(o)), 0), False, False, False)
             for o in ord_i_lista(tuple(rad))
             if 1 < len(o)
         ]
-        
-        if any(rd.läge is None for rd in rds):
-            raise ValueError
-        return rds
 
-    def vertikala_ord(self) -> list[Ord]:
-        """Alla ord som bildas längsmed kolumner"""
-
-        def lg(ix, o):
-            lg = Läge(max(0, "".join(self.kolumn(ix)).find(o)), ix, 1)
-            if lg is None:
-                raise ValueError
-            return lg
+    def ord_i_kolumn(self, ix: int) -> list[Ord]:
+        """Alla ord som bildas längsmed kolumnen
 
-        rds = [
-            Ord(o, lg(ix, o), False, False, False)
-            for ix, kol in enumerate(self.kolumner())
+        Läget är där ordet först förekommer i kolumnen.
+        """
+        kol = self.kolumnceller[ix]
+        text = "".join(kol)
+        return [
+            Ord(o, Läge(max(0, text.find(o)), ix, 1), False, False, False)
             for o in ord_i_lista(tuple(kol))
             if 1 < len(o)
         ]
-        if any(rd.läge is None for rd in rds):
-            raise ValueError
-        return rds
+
+    def horisontella_ord(self) -> list[Ord]:
+        """Alla ord som bildas längsmed rader"""
+        return [rd for ix in range(len(self.celler)) for rd in self.ord_i_rad(ix)]
+
+    def vertikala_ord(self) -> list[Ord]:
+        """Alla ord som bildas längsmed kolumner"""
+        return [rd for ix in range(len(self.kolumnceller)) for rd in self.ord_i_kolumn(ix)]
 
     def alla_ord(self) -> list[Ord]:
         """Alla ord som bildas i korsordet"""
         alla = [*self.horisontella_ord(), *self.vertikala_ord()]
         return alla
 
+    def linjer(self, rd: Ord) -> tuple[list[int], list[int]]:
+        """Raderna och kolumnerna som ordet går längsmed eller korsar"""
+        if rd.horisontellt:
+            rader = [rd.läge.x] if rd.läge.x < self.höjd else []
+            kolumner = list(range(rd.läge.y, min(rd.läge.y + len(rd), self.bredd)))
+        else:
+            rader = list(range(rd.läge.x, min(rd.läge.x + len(rd), self.höjd)))
+            kolumner = [rd.läge.y] if rd.läge.y < self.bredd else []
+        return rader, kolumner
+
+    def ord_i_linjer(self, rader: list[int], kolumner: list[int]) -> list[Ord]:
+        """Orden i raderna och kolumnerna, i samma ordning som i alla_ord"""
+        return [
+            *(rd for ix in rader for rd in self.ord_i_rad(ix)),
+            *(rd for ix in kolumner for rd in self.ord_i_kolumn(ix)),
+        ]
+
     def rad(self, ix: int) -> list[str]:
-        return self.rader()[ix]
+        """En kopia av raden, som inte ändras av senare ord"""
+        return list(self.celler[ix])
 
     def kolumn(self, ix: int) -> list[str]:
-        return self.kolumner()[ix]
+        """En kopia av kolumnen, som inte ändras av senare ord"""
+        return list(self.kolumnceller[ix])
 
     
-    def nya_ord(self, ref: list[Ord]):
-        ord_just_nu = self.alla_ord()
+    @mätning.tidtagen("nya_ord")
+    def nya_ord(self, ref: list[Ord], linjer: tuple[list[int], list[int]]):
+        """Ord i linjerna som inte fanns i ref och inte redan väntar bland aparta
+
+        Linjerna ska vara alla som ändrats sedan ref togs fram, övriga ord är oförändrade.
+        """
+        ord_just_nu = self.ord_i_linjer(*linjer)
         aparta = [ap for sk in self.aparta.values() for ap in sk]
         if any(ap.läge is None for ap in aparta):
             raise ValueError("Hur hände det att något blev None")
             # något med ord som ersätts av längre ord
             # något med att de plötsligt får läge None
-        fällda = []
-        for rd in ord_just_nu:
-            sedd = any(obs.lägeskänslig(rd) for obs in ref)
-            upplockad = any(obs.lägeskänslig(rd) for obs in aparta)
-            if sedd or upplockad:
-                continue
-            else:
-                fällda.append(rd)
-        if any(ap.läge is None for ap in fällda):
-            raise ValueError("Hur hände det att något blev None")
+        kända = {obs.nyckel for obs in ref} | {obs.nyckel for obs in aparta}
+        fällda = [rd for rd in ord_just_nu if rd.nyckel not in kända]
         return sorted(fällda, key=len, reverse=True)
 
+    @mätning.tidtagen("sätt")
     def sätt(self, rd: Ord):
         self.konsol.log(f"Prövar att lägga till [dark_sea_green4]{rd.ord}...")
-        cnt = self.alla_ord()
+        self.registrera(rd)
+        mätning.räkna("placeringar")
+        linjer = self.linjer(rd)
+        cnt = self.ord_i_linjer(*linjer)
         self.ord.append(rd)
-        if fällda := [o for o in self.nya_ord(cnt) if o != rd]:
+        self.spår.append(rd)
+        self.måla(rd)
+        if fällda := [o for o in self.nya_ord(cnt, linjer) if o != rd]:
+            mätning.räkna("biverkningar", len(fällda))
             self.konsol.log(f"[orange3]{rd.ord} skapade {len(fällda)} biverkningar...")
             self.aparta[rd] = fällda
         return fällda
 
+    def registrera(self, rd: Ord):
+        """Spara placeringen i historiken och jämför med facit vid uppspelning"""
+        placering = [rd.ord, list(astuple(rd.läge)), rd.pre, rd.post]
+        if self.facit is not None:
+            ix = len(self.historik)
+            förväntad = self.facit[ix] if ix < len(self.facit) else None
+            if placering != förväntad:
+                raise Avvikelse(ix, förväntad, placering)
+        self.historik.append(placering)
+
+    @property
+    def uppspelad(self) -> bool:
+        return self.facit is not None and len(self.facit) <= len(self.historik)
+
+    def spara_inspelning(self, sökväg: Path):
+        inspelning = {
+            "frö": self.frö,
+            "höjd": self.höjd,
+            "bredd": self.bredd,
+            "placeringar": self.historik,
+        }
+        with Path(sökväg).open(mode="w", encoding="utf-8") as fil:
+            json.dump(inspelning, fil, ensure_ascii=False)
+
     def stubbar(self):
         for stubb in sorted([o for o in self.ord if 1 < len(o.ord) if not o.pre or not o.post], key=len):
             kompatibla = self.ordlista.kompatibla(stubb.ord)
@@ -465,7 +789,7 @@ class Korsord:
                 continue
             kors = self[stubb.läge.slice()]
             if not kompatibla:
-                stubb.stäng(post=True)
+                self.stäng(stubb, post=True)
             if not (kors.tömd is Riktning(stubb.läge.z) or kors.tömd is Riktning.BÅDA):
                 self.konsol.log(f"[dark_sea_green4]Fortsätter på {stubb.ord}...")
                 yield from kors.möjligheter(kompatibla, överskrift=True, enbart=Riktning(stubb.läge.z))
@@ -473,9 +797,9 @@ class Korsord:
                 slut = stubb.läge + len(stubb) + 1
                 finns = next((krs for krs in self.kors.values() if krs.läge == slut), None)
                 if finns and finns.origo is Ruta.TOM:
-                    stubb.stäng(post=True)
+                    self.stäng(stubb, post=True)
                 else:
-                    stubb.stäng()
+                    self.stäng(stubb)
 
     def mellanrum(self):
         for krs in self.kors.values():
@@ -491,33 +815,14 @@ class Korsord:
                 yield from krs.möjligheter(kompatibla, enbart=Riktning.VERTIKALT, töm=False)
 
     def generera_kors(self):
-        import random
-        svåra_hakningar = "ZXCFHBYQUWJÅÄÖ"
-        sortering = dict(zip(svåra_hakningar, range(len(svåra_hakningar))))
-        def sortera(kors):
-            return sortering.get(kors.origo, random.randrange(0, 20))
-
-        while True:
-            try:
-                kors = sorted([k for k in self.kors.values() if not (k.låst or k.tom or k.kant or k.tömd is Riktning.BÅDA)])
-                random.shuffle(kors)
-                # friheter 
-                yield from (a for a in sorted(kors, key=sortera, reverse=True)[:10])
-                hori = (a for a in sorted(kors, key=attrgetter("friheter_horisontellt"), reverse=True))
-                verti = (a for a in sorted(kors, key=attrgetter("friheter_vertikalt"), reverse=True))
-                for ax in zip(hori, verti):
-                    yield choice(ax)
-
-                # svåra bokstäver
-
-            except Fortare:
-                self.konsol.log(f"[dark_sea_green4]Startar om korshårsloopen...")
-                continue
+        """Korsen i tur och ordning från korskön, tills inga kan få fler ord"""
+        while (kors := self.korskö.nästa()) is not None:
+            yield kors
+            self.korskö.prövat(kors)
 
     def möjligheter(self):
-        import random
         korshår = self.generera_kors()
-        seed = random.random()
+        seed = self.slump.random()
         while True:
             try:
                 yield from self.stubbar()
@@ -532,119 +837,250 @@ class Korsord:
                 else:
                     break
             except Fortare:
-                korshår.throw(Fortare)
+                # Korskön har redan ändrats av det nya ordet, så den fortsätter där den är
                 continue
 
-    def hantera_aparta(self, rd: Ord = None, aparta: list[Ord] = None):
-        """Rekursiv funktion för att lösa ogiltiga ord"""
-        nya = []
-
-        # Enter case
-        if rd is None:
-            rd, aparta = next(iter(self.aparta.items()))
-            self.konsol.log(f"[yellow]Hanterar aparta följder av {rd.ord}")
-            lyckat, knoppar = self.hantera_aparta(rd, aparta)
-            if lyckat:
-                self.konsol.log(f"[dark_sea_green4]{rd.ord} fungerade :smiley: :smiley: :smiley:")
-                for kn in knoppar:
-                    if kn not in self.ord:
-                        self.konsol.log(f"[red3]{rd.ord} WTF")
-                return True
-            else:
-                self.konsol.log(f"[red3]{rd.ord} fungerade inte")
-                self.ångra(rd)
-                for n in knoppar:
-                    self.ångra(n)
-                self.aparta.pop(rd, None)
-                return False
-
-        aparta_str = ", ".join([a.ord for a in aparta])
-        self.konsol.log(f"Hanterar biverkningar av ordet {rd.ord}: [plum1]{aparta_str}[/plum1]")
+    def ogiltigt(self, aparta: list[Ord]) -> Ord | None:
+        """Den första biverkningen som varken är ett ord eller kan bli en del av ett"""
         for apa in aparta:
             if apa not in self.ordlista and (3 < len(apa.ord) or not self.ordlista.kompatibla(apa.ord)):
-                self.konsol.log(f"[plum1]{rd.ord}[/plum1] kastades eftersom [deep_pink4]{apa.ord}[/deep_pink4] är ogiltigt")
-                return False, nya
+                return apa
+        return None
+
+    def i_rutnätet(self, rd: Ord) -> bool:
+        """Om ordets bokstäver bildar ett ord någonstans i rutnätet, först sökt i dess egen linje"""
+        egen = self.ord_i_rad(rd.läge.x) if rd.horisontellt else self.ord_i_kolumn(rd.läge.y)
+        return rd in egen or rd in self.alla_ord()
+
+    def lokalt(self, rd: Ord) -> tuple:
+        """Nyckeln för en biverkning i misslyckade: ordet, läget och linjen det ligger i"""
+        linje = self.celler[rd.läge.x] if rd.horisontellt else self.kolumnceller[rd.läge.y]
+        return rd.ord, rd.läge.x, rd.läge.y, rd.läge.z, "".join(linje)
+
+    @mätning.tidtagen("hantera_aparta")
+    def hantera_aparta(self, frist: float = None) -> bool:
+        """Laga biverkningarna av det först satta ordet i aparta, eller ångra det
+
+        Varje biverkning ersätts med ett ord som passar i dess kors, vars egna
+        biverkningar lagas på samma sätt, med en egen stack i stället för rekursion.
+        Sökningen ges upp efter reparationsnoder prövade ord eller när frist (i
+        time.monotonic()) passeras, och går högst reparationsdjup nivåer ned.
+        Biverkningar som inte gick att laga minns tills deras linje ändras.
+        """
+        rd, aparta = next(iter(self.aparta.items()))
+        self.konsol.log(f"[yellow]Hanterar aparta följder av {rd.ord}")
+        start = time.monotonic()
+        stat = Reparation(rd.ord)
+        punkt = self.kontrollpunkt(rd)
+
+        stack = [Ram(rd, aparta, 1)]
+        utfall = None  # Hur det gick för nivån som just togs bort från stacken
+        while stack:
+            ram = stack[-1]
+            if utfall is True:
+                self.konsol.log(f"[dark_sea_green4]Biverkningar från {ram.prövat.ord} kunde hanteras...")
+                ram.möjliga, ram.ix = None, ram.ix + 1
+            elif utfall is False:
+                self.konsol.log(f"[plum1]Biverkningar från {ram.prövat.ord} kunde inte hanteras...")
+                self.återgå(ram.punkt)
+            utfall = None
+
+            if stat.noder >= self.reparationsnoder or (frist is not None and frist < time.monotonic()):
+                stat.avbruten = True
+                break
 
-        for apa in aparta:
-            self.konsol.log(f"Hanterar [yellow]{apa.ord}...")
-            if not apa in self.alla_ord():
-                self.konsol.log(f"{apa.ord} har försvunnit ur rutnätet...")
-                continue 
-            
-            korshår = self[apa.läge.slice()]
-            kompatibla = self.ordlista.kompatibla(apa.ord)
-            if apa in self.ordlista:
-                self.konsol.log(f"[dark_sea_green4]{apa.ord} finns redan i ordlistan...")
-                kompatibla += [Ord(*astuple(apa)).reset()]
-            
-            for m in korshår.möjligheter(reversed(kompatibla), enbart=Riktning(apa.läge.z), cache_w=False, cache_r=True, töm=False, överskrift=True):
-                biverkningar = self.sätt(m)
-                if not biverkningar:
-                    nya.append(m)
-                    self.konsol.log(f"[dark_sea_green4]{m.ord} gav inga biverkningar...")
-                    break
-                lyckat, knoppar = self.hantera_aparta(m, biverkningar)
-                if lyckat:
-                    nya.append(m)
-                    nya += knoppar
-                    self.konsol.log(f"[dark_sea_green4]Biverkningar från {m.ord} kunde hanteras...")
-                    break
-                else:
-                    self.konsol.log(f"[plum1]Biverkningar från {m.ord} kunde inte hanteras...")
-                    self.ångra(m)
-                    for kn in knoppar:
-                        self.ångra(kn)
-                    self.aparta.pop(m, None)
+            if ram.möjliga is None:
+                if ram.ix == 0:
+                    aparta_str = ", ".join([a.ord for a in ram.aparta])
+                    self.konsol.log(f"Hanterar biverkningar av ordet {ram.ord.ord}: [plum1]{aparta_str}[/plum1]")
+                    if apa := self.ogiltigt(ram.aparta):
+                        self.konsol.log(f"[plum1]{ram.ord.ord}[/plum1] kastades eftersom [deep_pink4]{apa.ord}[/deep_pink4] är ogiltigt")
+                        utfall = self.släpp(stack)
+                        continue
+                utfall = self.nästa_apa(ram, stat)
+                if utfall is True:
+                    stack.pop()
+                    continue
+                if utfall is False:
+                    self.släpp(stack)
                     continue
+
+            m = next(ram.möjliga, None)
+            if m is None:
+                apa = ram.aparta[ram.ix]
+                self.konsol.log(f"[plum1]{ram.ord.ord}[/plum1] kastades eftersom {apa} inte hade några bra hakningar...")
+                if not ram.avskuren:
+                    self.misslyckade.add(ram.nyckel)
+                utfall = self.släpp(stack)
+                continue
+
+            stat.noder += 1
+            ram.punkt = self.kontrollpunkt()
+            ram.prövat = m
+            biverkningar = self.sätt(m)
+            if not biverkningar:
+                self.konsol.log(f"[dark_sea_green4]{m.ord} gav inga biverkningar...")
+                ram.möjliga, ram.ix = None, ram.ix + 1
+            elif ram.djup < self.reparationsdjup:
+                stack.append(Ram(m, biverkningar, ram.djup + 1))
+                stat.djup = max(stat.djup, ram.djup + 1)
             else:
-                self.konsol.log(f"[plum1]{rd.ord}[/plum1] kastades eftersom {apa} inte hade några bra hakningar...")
-                return False, nya
+                ram.avskuren = True
+                utfall = False
+
+        lyckat = utfall is True and not stack
+        stat.lyckad = lyckat
+        stat.sekunder = time.monotonic() - start
+        self.reparationer.append(stat)
+        mätning.räkna("reparationsnoder", stat.noder)
+        if stat.avbruten:
+            mätning.räkna("avbrutna reparationer")
+        if lyckat:
+            self.konsol.log(f"[dark_sea_green4]{rd.ord} fungerade :smiley: :smiley: :smiley:")
+        else:
+            self.konsol.log(f"[red3]{rd.ord} fungerade inte ({stat.noder} ord prövade)")
+            self.återgå(punkt)
+        if len(self.misslyckade) > MISSLYCKADE:
+            self.misslyckade.clear()
+        return lyckat
+
+    def nästa_apa(self, ram: Ram, stat: Reparation) -> bool | None:
+        """Förbered nästa biverkning i ramen som finns kvar i rutnätet
+
+        True om alla är lagade, False om nästa redan är känd som omöjlig och
+        annars None, med ramens möjliga ord på plats.
+        """
+        while ram.ix < len(ram.aparta):
+            apa = ram.aparta[ram.ix]
+            self.konsol.log(f"Hanterar [yellow]{apa.ord}...")
+            if self.i_rutnätet(apa):
+                break
+            self.konsol.log(f"{apa.ord} har försvunnit ur rutnätet...")
+            ram.ix += 1
+        else:
+            self.aparta.pop(ram.ord)
+            self.konsol.log(f"[dark_sea_green4]Behåller [light_sea_green]{ram.ord.ord}[/light_sea_green] för tillfället...[/dark_sea_green4]")
+            return True
+
+        ram.nyckel = self.lokalt(apa)
+        if ram.nyckel in self.misslyckade:
+            stat.minnesträffar += 1
+            mätning.räkna("minnesträffar")
+            self.konsol.log(f"[plum1]{ram.ord.ord}[/plum1] kastades eftersom {apa.ord} redan har misslyckats här...")
+            return False
 
-        self.aparta.pop(rd)
-        self.konsol.log(f"[dark_sea_green4]Behåller [light_sea_green]{rd.ord}[/light_sea_green] för tillfället...[/dark_sea_green4]")
-        return True, nya
+        korshår = self[apa.läge.slice()]
+        kompatibla = self.ordlista.kompatibla(apa.ord)
+        if apa in self.ordlista:
+            self.konsol.log(f"[dark_sea_green4]{apa.ord} finns redan i ordlistan...")
+            kompatibla += [Ord(*astuple(apa)).reset()]
+        ram.möjliga = korshår.möjligheter(
+            reversed(kompatibla), enbart=Riktning(apa.läge.z), cache_w=False, cache_r=True, töm=False, överskrift=True
+        )
+        return None
+
+    @staticmethod
+    def släpp(stack: list[Ram]) -> bool:
+        """Ta bort den misslyckade ramen överst i stacken"""
+        ram = stack.pop()
+        if stack:
+            stack[-1].avskuren |= ram.avskuren
+        return False
+
+    def kontrollpunkt(self, rd: Ord = None) -> int:
+        """En punkt i spåret att återgå till, just nu eller just innan rd sattes"""
+        if rd is None:
+            return len(self.spår)
+        for ix in reversed(range(len(self.spår))):
+            if self.spår[ix] is rd:
+                return ix
+        raise ValueError(f"{rd.ord} finns inte i spåret")
+
+    def återgå(self, punkt: int):
+        """Ångra alla ord som satts efter kontrollpunkten, det senaste först
+
+        Varje ord kostar bara sina egna rutor, och ligger sist i ordlistan om
+        inget ord har ångrats i oordning sedan dess.
+        """
+        while punkt < len(self.spår):
+            rd = self.spår.pop()
+            self.konsol.log(f"[red3] ångrar {rd.ord}...")
+            mätning.räkna("ångra")
+            if self.ord and self.ord[-1] is rd:
+                self.ord.pop()
+            else:
+                self.ord.pop(next(ix for ix in reversed(range(len(self.ord))) if self.ord[ix] is rd))
+            self.aparta.pop(rd, None)
+            self.sudda(rd)
 
     def ångra(self, ord: Ord):
-        self.konsol.log(f"[red3] ångrar {ord.ord}...")
-        self.ord.reverse()
-        self.ord.remove(ord)
-        self.ord.reverse()
+        """Ångra just det här ordet, och låt de som satts efter det ligga kvar"""
+        punkt = self.kontrollpunkt(ord)
+        senare = self.spår[punkt + 1 :]
+        del self.spår[punkt + 1 :]
+        self.återgå(punkt)
+        self.spår += senare
         return self
 
     def rensa(self):
-        rens = []
+        """Ta bort orden som har samma bokstäver som ett kortare ord på ett läge
+        där ett längre ord har samma läge och riktning"""
+        def läge(rd):
+            return rd.läge.x, rd.läge.y, rd.läge.z
+
+        längst = defaultdict(int)
         for rd in self.ord:
-            längre = [dvrg for dvrg in self.ord if rd.läge.lägeskänslig(dvrg.läge) and len(dvrg) < len(rd)]
-            rens += längre
-        self.ord = [rd for rd in self.ord if not next((True for ren in rens if rd.lägeskänslig(ren)), False)]
+            längst[läge(rd)] = max(längst[läge(rd)], len(rd))
+        rens = {(rd.ord, läge(rd)) for rd in self.ord if len(rd) < längst[läge(rd)]}
+        self.ord = [rd for rd in self.ord if (rd.ord, läge(rd)) not in rens]
+        kvar = {id(rd) for rd in self.ord}
+        self.spår = [rd for rd in self.spår if id(rd) in kvar]
+        self.måla_om()
 
 
     def starta(self):
-        startord = [o for o in self.ordlista.ord if o.special]
-        start = choice(string.ascii_letters).upper()
-        kors = choice(list(self.kors.values()))
+        startord = self.ordlista.specialord()
+        start = self.slump.choice(string.ascii_letters).upper()
+        kors = self.slump.choice(list(self.kors.values()))
         self.sätt(Ord(start, kors.läge, False, False, False))
         start = kors.möjligheter(startord)
         self.sätt(next(start))
         return self
 
-    def poängräkning(self):
-        poäng = sum(o.poäng for o in self.ord)
-        täckning = sum(
+    def fyllnadsgrad(self) -> float:
+        """Andelen rutor med en bokstav"""
+        bokstäver = sum(
             (isinstance(bks, str) and bks.isalpha() for r in self.rader() for bks in r)
         )
-        täckning = täckning / (self.bredd * self.höjd)
+        return bokstäver / (self.bredd * self.höjd)
+
+    def poängräkning(self):
+        poäng = sum(o.poäng(self.slump) for o in self.ord)
         medel = mean(len(o.ord) for o in self.ord) if self.ord else 0
-        return poäng * medel * täckning
+        return poäng * medel * self.fyllnadsgrad()
+
+    def kopiera_ord(self) -> list[Ord]:
+        """Kopior av de satta orden, som inte ändras när orden stängs"""
+        return [
+            Ord(o.ord, Läge(o.läge.x, o.läge.y, o.läge.z), o.special, o.pre, o.post)
+            for o in self.ord
+        ]
+
+    def återställ(self, ord: list[Ord]):
+        """Gå tillbaka till orden från kopiera_ord"""
+        self.ord = list(ord)
+        self.aparta.clear()
+        self.spår = list(ord)
+        self.måla_om()
 
 
 
-@lru_cache(maxsize=2000000)
 def giltig(uno, dos):
     return uno == dos or dos is Ruta.TOM
 
 
-@lru_cache(maxsize=2000000)
+@mätning.tidtagen("passar")
+@cachning.cachad("passar", 8 * MB, cachning.KORSORD, nyckel=lambda rd, bks: (str(rd), bks))
 def passar(rd: Ord, bks: tuple[str]):
     if len(bks) < len(rd):
         return False
@@ -672,15 +1108,15 @@ class Kors:
 
     @property
     def rad(self):
-        return self.korsord.rader()[self.läge.x]
+        return self.korsord.rad(self.läge.x)
 
     @property
     def kol(self):
-        return self.korsord.kolumner()[self.läge.y]
+        return self.korsord.kolumn(self.läge.y)
 
     @property
     def origo(self):
-        return self.rad[self.läge.y]
+        return self.korsord.celler[self.läge.x][self.läge.y]
 
     @property
     def gåta(self):
@@ -692,32 +1128,41 @@ class Kors:
 
     @property
     def n(self):
-        return self.kol[0 : self.läge.x]
+        return self.korsord.kolumnceller[self.läge.y][0 : self.läge.x]
 
     @property
     def e(self):
-        return self.rad[self.läge.y + 1 :]
+        return self.korsord.celler[self.läge.x][self.läge.y + 1 :]
 
     @property
     def s(self):
-        return self.kol[self.läge.x + 1 :]
+        return self.korsord.kolumnceller[self.läge.y][self.läge.x + 1 :]
 
     @property
     def w(self):
-        return self.rad[0 : self.läge.y]
+        return self.korsord.celler[self.läge.x][0 : self.läge.y]
+
+    def granne(self, riktning: str) -> str | None:
+        """Rutan bredvid åt n, e, s eller w, eller None vid kanten"""
+        x, y = self.läge.x, self.läge.y
+        if riktning == "w":
+            return self.korsord.celler[x][y - 1] if 0 < y else None
+        if riktning == "e":
+            rad = self.korsord.celler[x]
+            return rad[y + 1] if y + 1 < len(rad) else None
+        if riktning == "n":
+            return self.korsord.kolumnceller[y][x - 1] if 0 < x else None
+        kol = self.korsord.kolumnceller[y]
+        return kol[x + 1] if x + 1 < len(kol) else None
 
     def _låst(self, riktningar: str):
-        ix = {"w": -1, "n": -1}
-        låsta = [
-            (not getattr(self, d) or getattr(self, d)[ix.get(d, 0)] is not Ruta.TOM)
-            for d in riktningar
-        ]
-        return all(låsta)
+        """Varje riktning slutar vid kanten eller har en bokstav eller ett block närmast"""
+        return all(
+            (granne := self.granne(d)) is None or granne is not Ruta.TOM for d in riktningar
+        )
 
     def _friheter(self, riktning):
-        step = {"n": -1, "w": -1}
-        fria = list(takewhile(lambda x: x is Ruta.TOM, getattr(self, riktning)[::step.get(riktning, 1)]))
-        return len(fria)
+        return self.korsord.friheter.fria(riktning, self.läge.x, self.läge.y)
 
     @property
     def friheter_horisontellt(self):
@@ -746,20 +1191,24 @@ class Kors:
     @property
     def mellanrum_e(self):
         if tomma := self._friheter("e"):
-            if not tomma < len(self.e):
-                return None    
-            if self.e[tomma] == Ruta.BLOCK.value:
+            rad = self.korsord.celler[self.läge.x]
+            bortom = self.läge.y + 1 + tomma
+            if not bortom < len(rad):
+                return None
+            if rad[bortom] == Ruta.BLOCK.value:
                 return None
-            return self.origo, self.e[tomma], tomma
+            return self.origo, rad[bortom], tomma
 
     @property
     def mellanrum_s(self):
         if tomma := self._friheter("s"):
-            if not tomma < len(self.s):
-                return None    
-            if self.s[tomma] == Ruta.BLOCK.value:
+            kol = self.korsord.kolumnceller[self.läge.y]
+            bortom = self.läge.x + 1 + tomma
+            if not bortom < len(kol):
+                return None
+            if kol[bortom] == Ruta.BLOCK.value:
                 return None
-            return self.origo, self.s[tomma], tomma
+            return self.origo, kol[bortom], tomma
 
     def låst_horisontellt(self):
         return self._låst("we")
@@ -914,6 +1363,160 @@ class Kors:
                 yield kp
         
 
+SVÅRA_HAKNINGAR = "ZXCFHBYQUWJÅÄÖ"
+
+
+def sällsynt(kors: Kors) -> float:
+    """Kors på bokstäver som få ord hakar i prövas först"""
+    return float(kors.origo in SVÅRA_HAKNINGAR)
+
+
+def frihet(kors: Kors) -> float:
+    """Kors med mest plats åt något håll prövas först"""
+    return max(kors.friheter_horisontellt, kors.friheter_vertikalt)
+
+
+def begränsning(kors: Kors) -> float:
+    """Kors med färst bokstäver eller block runt sig prövas först"""
+    return -sum(granne is not None and granne is not Ruta.TOM for granne in map(kors.granne, "nesw"))
+
+
+def slumpad(kors: Kors) -> float:
+    """Korsen prövas i slumpad ordning, som bara beror på korskön"""
+    return 0.0
+
+
+HEURISTIKER = {
+    "slumpad": slumpad,
+    "sällsynt": sällsynt,
+    "frihet": frihet,
+    "begränsning": begränsning,
+}
+
+
+class Korskö:
+    """Indexerad heap över korsen som kan få fler ord
+
+    Korsen ordnas efter hur många gånger de har prövats, och sedan efter
+    heuristiken, högst först. Korsord.uppdatera markerar raden och kolumnen
+    för varje ändrad ruta, och innan nästa kors tas ut får korsen i dem nya
+    platser i heapen, eller tas bort om de inte längre kan få fler ord. Att
+    ta ut ett kors kostar O(log n) plus de ändrade korsen.
+    """
+
+    def __init__(self, korsord: Korsord, heuristik, slump: Random):
+        self.korsord = korsord
+        self.heuristik = heuristik
+        self.slump = slump
+        self.rutor = {(k.läge.x, k.läge.y): k for k in korsord.kors.values()}
+        self.heap: list[list] = []  # [prioritet, (x, y)]
+        self.plats: dict[tuple[int, int], int] = {}
+        self.besök: dict[tuple[int, int], int] = defaultdict(int)
+        self.ändrade_rader = set(range(korsord.höjd))
+        self.ändrade_kolumner = set(range(korsord.bredd))
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, xy: tuple[int, int]):
+        return xy in self.plats
+
+    @staticmethod
+    def levande(kors: Kors) -> bool:
+        return not (kors.låst or kors.tom or kors.kant or kors.tömd is Riktning.BÅDA)
+
+    def ändrad(self, x: int, y: int):
+        """Korsen i rutans rad och kolumn kan ha fått andra friheter och grannar"""
+        self.ändrade_rader.add(x)
+        if y < self.korsord.bredd:
+            self.ändrade_kolumner.add(y)
+
+    def allt_ändrat(self):
+        self.ändrade_rader.update(range(self.korsord.höjd))
+        self.ändrade_kolumner.update(range(self.korsord.bredd))
+
+    def uppdatera(self):
+        ändrade = {(x, y) for x in self.ändrade_rader for y in range(self.korsord.bredd)}
+        ändrade.update((x, y) for y in self.ändrade_kolumner for x in range(self.korsord.höjd))
+        for xy in sorted(ändrade):
+            self.ställ_in(xy)
+        self.ändrade_rader.clear()
+        self.ändrade_kolumner.clear()
+
+    def ställ_in(self, xy: tuple[int, int]):
+        """Ge korset en ny plats i heapen, eller ta bort det"""
+        kors = self.rutor.get(xy)
+        if kors is None or not self.levande(kors):
+            self.ta_bort(xy)
+            return
+        prioritet = (self.besök[xy], -self.heuristik(kors), self.slump.random())
+        if xy in self.plats:
+            ix = self.plats[xy]
+            gammal = self.heap[ix][0]
+            self.heap[ix][0] = prioritet
+            if prioritet < gammal:
+                self._upp(ix)
+            else:
+                self._ned(ix)
+        else:
+            self.heap.append([prioritet, xy])
+            self.plats[xy] = len(self.heap) - 1
+            self._upp(len(self.heap) - 1)
+
+    def ta_bort(self, xy: tuple[int, int]):
+        ix = self.plats.pop(xy, None)
+        if ix is None:
+            return
+        sista = self.heap.pop()
+        if ix < len(self.heap):
+            self.heap[ix] = sista
+            self.plats[sista[1]] = ix
+            self._upp(ix)
+            self._ned(self.plats[sista[1]])
+
+    def nästa(self) -> Kors | None:
+        """Ta ut korset som står först i tur, eller None om inga finns kvar"""
+        self.uppdatera()
+        while self.heap:
+            xy = self.heap[0][1]
+            self.ta_bort(xy)
+            kors = self.rutor[xy]
+            # tömd kan ha ändrats utan att någon ruta gjorde det
+            if self.levande(kors):
+                return kors
+        return None
+
+    def prövat(self, kors: Kors):
+        """Lägg tillbaka ett kors som har prövats, efter dem som prövats färre gånger"""
+        xy = (kors.läge.x, kors.läge.y)
+        self.besök[xy] += 1
+        self.ställ_in(xy)
+
+    def _byt(self, i: int, j: int):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.plats[self.heap[i][1]] = i
+        self.plats[self.heap[j][1]] = j
+
+    def _upp(self, ix: int):
+        while ix:
+            förälder = (ix - 1) // 2
+            if not self.heap[ix][0] < self.heap[förälder][0]:
+                break
+            self._byt(ix, förälder)
+            ix = förälder
+
+    def _ned(self, ix: int):
+        while True:
+            minst = ix
+            for barn in (2 * ix + 1, 2 * ix + 2):
+                if barn < len(self.heap) and self.heap[barn][0] < self.heap[minst][0]:
+                    minst = barn
+            if minst == ix:
+                return
+            self._byt(ix, minst)
+            ix = minst
+
+
 class Inkompatibel(Exception):
     def __init__(self, ord=None, för=None):
         super().__init__()
@@ -925,35 +1528,106 @@ class Fortare(Exception):
     pass
 
 
-def generera(korsord: Korsord, tidsgräns=60) -> Korsord:
+class Avvikelse(Exception):
+    """Uppspelningen placerade inte samma ord som inspelningen"""
+
+    def __init__(self, ix=None, förväntad=None, placering=None):
+        super().__init__(f"Placering {ix}: väntade {förväntad}, fick {placering}")
+        self.ix = ix
+        self.förväntad = förväntad
+        self.placering = placering
+
+
+def generera(
+    korsord: Korsord, tidsgräns=60, efter_steg=None, ögonblicksbild=None, intervall=1.0
+) -> Korsord:
+    """Fyll korsordet tills möjligheterna tar slut eller tidsgränsen (i sekunder) nås
+
+    efter_steg anropas med korsordet efter varje prövat ord. Det fylligaste rutnätet
+    hittills sparas, och är det som finns kvar i korsordet på slutet, även efter
+    Ctrl-C. ögonblicksbild anropas högst var intervall:e sekund med en bild av det.
+    """
     möjligt = korsord.möjligheter()
+    start = time.monotonic()
+    senaste_bild = start
+    bäst = {
+        "tid": 0,
+        "fyllnadsgrad": korsord.fyllnadsgrad(),
+        "ord": korsord.kopiera_ord(),
+        "rader": korsord.rendera(),
+    }
     c = console.Console()
     with Live(korsord, console=korsord.konsol, auto_refresh=False) as live:
         
         while True:
             try:
-                mh = next(möjligt, None)
+                if korsord.uppspelad:
+                    break
+                if tidsgräns is not None and tidsgräns < time.monotonic() - start:
+                    break
+                with mätning.tid("kandidater"):
+                    mh = next(möjligt, None)
                 if not mh:
                     break
                 antal = len(korsord.ord)
                 korsord.sätt(mh)
                 if korsord.aparta:
-                    korsord.hantera_aparta()
+                    korsord.hantera_aparta(frist=None if tidsgräns is None else start + tidsgräns)
                 if mh in korsord:
                     korsord.rensa()
                     möjligt.throw(Fortare())
 
+                fyllnadsgrad = korsord.fyllnadsgrad()
+                if bäst["fyllnadsgrad"] < fyllnadsgrad:
+                    bäst = {
+                        "tid": time.monotonic() - start,
+                        "fyllnadsgrad": fyllnadsgrad,
+                        "ord": korsord.kopiera_ord(),
+                        "rader": korsord.rendera(),
+                    }
+                if ögonblicksbild and intervall <= time.monotonic() - senaste_bild:
+                    senaste_bild = time.monotonic()
+                    ögonblicksbild(bäst)
+
+                if efter_steg:
+                    efter_steg(korsord)
                 live.refresh()
             except KeyboardInterrupt:
-                live.refresh()
-                break 
+                korsord.konsol.log("[yellow]Avbrutet, behåller det bästa rutnätet hittills...")
+                break
+
+    # Efter ett avbrott kan ett ord vara halvvägs hanterat
+    if korsord.aparta or bäst["fyllnadsgrad"] > korsord.fyllnadsgrad():
+        korsord.återställ(bäst["ord"])
     return korsord
 
 
-def main(tidsgräns=None):
-    with Ordlista() as ordlista:
-        with Korsord(20, 20, ordlista, console.Console()) as korsord:
+def main(tidsgräns=None, frö=None, inspelning=None, uppspelning=None, statistik=False):
+    """Generera ett korsord
+
+    Med frö blir körningen reproducerbar. Med inspelning sparas frö och placeringar,
+    och med uppspelning körs en inspelad körning om exakt, t.ex. under en profilerare.
+    Med statistik skrivs räknare och tider för de heta delarna ut på slutet.
+    """
+    if statistik:
+        mätning.aktivera()
+    facit = None
+    if uppspelning:
+        with Path(uppspelning).open(encoding="utf-8") as fil:
+            inspelad = json.load(fil)
+        frö, facit = inspelad["frö"], inspelad["placeringar"]
+    if frö is None:
+        frö = randrange(2 ** 32)
+
+    slump = Random(frö)
+    with Ordlista(slump=slump) as ordlista:
+        with Korsord(20, 20, ordlista, console.Console(), frö=frö, slump=slump, facit=facit) as korsord:
             gen = generera(korsord, tidsgräns=tidsgräns)
+            if inspelning:
+                korsord.spara_inspelning(inspelning)
+    if statistik:
+        print(mätning.avaktivera().rapport())
+        print(cachning.rapport())
 
 
 if __name__ == "__main__":
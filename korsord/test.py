@@ -1,15 +1,13 @@
-from korsord.rutnät import mellanrum, Ruta, fyller_mellanrum
+from korsord.ordindex import Ordindex
 
 from rich import print
 
 
 if __name__ == "__main__":
-    #print(mellanrum("".join([Ruta.TOM, "J"])))
-    #print(mellanrum(Ruta.TOM + Ruta.TOM))
-    #print(mellanrum(""))
-
-    print(fyller_mellanrum("A", "M", "ARM"))
-    print(fyller_mellanrum("A", "M", "KAR"))
-    print(fyller_mellanrum("A", "M", "KRAM"))
-    print(fyller_mellanrum("A", "M", "KARM"))
-    print(fyller_mellanrum("A", "M", "KARRM"))
\ No newline at end of file
+    # Orden där A följs av M med en eller två bokstäver emellan, som Ordlista.mellanrum
+    ord = ["ARM", "KAR", "KRAM", "KARM", "KARRM"]
+    index = Ordindex.bygg(ord)
+    träffar = {ix for mellan in range(1, 3) for ix in index.mellanrum("A", mellan, "M")}
+
+    for ix, rd in enumerate(ord):
+        print(rd, ix in träffar)
@@ -0,0 +1,82 @@
+import json
+
+
+class ReplayError(Exception):
+    """Raised when a replayed run does not place the same words as the recording."""
+
+
+class Recording:
+    """The seed, settings and placements of a generation run.
+
+    Replaying a recording runs the same search again, with the number of slots every
+    search visited, and the number of placements in each loop, standing in for the
+    timeouts. The replay then does exactly the same work as the original run, even
+    when it runs much slower (e.g. under a profiler).
+
+    Recordings saved before the scans were recorded have scans set to None, and only
+    replay as long as no search was cut short by its timeout.
+    """
+
+    def __init__(self, seed, settings=None, loops=None, scans=None):
+        self.seed = seed
+        self.settings = settings or {}
+        self.loops = loops or []
+        self.scans = scans if scans is not None or self.loops else []
+
+    def start_loop(self):
+        self.loops.append([])
+        if self.scans is not None:
+            self.scans.append([])
+
+    def record(self, placement):
+        """Adds a placement, i.e. a {"word", "location", "D"} dict, to the current loop."""
+        self.loops[-1].append(placement)
+
+    def record_scan(self, slots):
+        """Adds the number of slots a search visited to the current loop."""
+        if self.scans is not None:
+            self.scans[-1].append(slots)
+
+    def scans_in_loop(self, loop):
+        """Returns the number of slots every search of the loop visited, or None if
+        they weren't recorded."""
+        if self.scans is None:
+            return None
+        return self.scans[loop] if loop < len(self.scans) else []
+
+    def placements_in_loop(self, loop):
+        return len(self.loops[loop]) if loop < len(self.loops) else 0
+
+    def check(self, loop, position, placement):
+        """Raises ReplayError if the placement isn't the one recorded at that position."""
+        expected = None
+        if position < self.placements_in_loop(loop):
+            expected = self.loops[loop][position]
+
+        if placement != expected:
+            raise ReplayError(
+                "Replay diverged in loop {}, placement {}: expected {}, got {}.".format(
+                    loop + 1, position + 1, expected, placement
+                )
+            )
+
+    def save(self, filename):
+        with open(filename, "w", encoding="utf-8") as recording_file:
+            json.dump(
+                {
+                    "seed": self.seed,
+                    "settings": self.settings,
+                    "loops": self.loops,
+                    "scans": self.scans,
+                },
+                recording_file,
+                ensure_ascii=False,
+                indent=1,
+            )
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, encoding="utf-8") as recording_file:
+            data = json.load(recording_file)
+
+        return cls(data["seed"], data.get("settings"), data.get("loops"), data.get("scans"))
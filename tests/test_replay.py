@@ -0,0 +1,65 @@
+import json
+import random
+import sys
+
+import pytest
+
+import crossword_generator
+from grid_generator import BulkGridGenerator, GridGenerator
+from recording import Recording
+
+
+def make_words(count=3000, seed=0):
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choice("aeioulnrst") for _ in range(rng.randint(3, 8)))
+        for _ in range(count)
+    ]
+
+
+def generate(generator_class, seed, timeout, replay=None):
+    generator = generator_class(make_words(), (12, 12), 2, timeout, 1.0, seed, replay)
+    generator.generate_grid()
+    return generator
+
+
+@pytest.mark.parametrize("generator_class", [GridGenerator, BulkGridGenerator])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_replay_with_searches_cut_by_timeout(generator_class, seed, tmp_path):
+    # With a tiny timeout, most searches stop after a few slots
+    run = generate(generator_class, seed, 0.1)
+    recording = run.get_recording()
+    assert any(recording.scans)
+
+    path = tmp_path / "recording.json"
+    recording.save(path)
+    replay = generate(generator_class, seed, 0.1, Recording.load(path))
+
+    assert replay.get_recording().loops == recording.loops
+    assert replay.get_recording().scans == recording.scans
+    assert replay.get_words_in_grid() == run.get_words_in_grid()
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["crossword_generator.py", *map(str, args)])
+    crossword_generator.main()
+
+
+def test_replay_batch_file(monkeypatch, tmp_path):
+    word_file = tmp_path / "words.txt"
+    word_file.write_text("\n".join(make_words()), encoding="utf-8")
+    out_dir = tmp_path / "out"
+    run_main(
+        monkeypatch,
+        "-f", word_file, "-d", 10, "-n", 2, "-t", 1, "-s", 2, "--count", 2, "--out-dir", out_dir,
+    )
+
+    for batch_file in sorted(out_dir.glob("grid-*.json")):
+        replayed_file = tmp_path / "replayed.json"
+        run_main(monkeypatch, "--replay", batch_file, "--json", replayed_file)
+
+        batch = json.loads(batch_file.read_text(encoding="utf-8"))
+        replayed = json.loads(replayed_file.read_text(encoding="utf-8"))
+        assert replayed["seed"] == batch["seed"]
+        assert replayed["cells"] == batch["cells"]
+        assert replayed["words"] == batch["words"]
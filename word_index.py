@@ -0,0 +1,125 @@
+import random
+
+import metrics
+
+
+class WordIndex:
+    """Indexes words by (length, position, letter), so that every word matching
+    a partially-filled slot can be found without trying words one by one.
+
+    Each word gets one bit in the bitset of its length. Bitsets are plain Python
+    ints, so matching a pattern is just a few ANDs, one per filled cell.
+    """
+
+    def __init__(self, words):
+        self.words = {}  # length -> list of words, the bit index is the list index
+        self.masks = {}  # (length, position, letter) -> bitset
+        self.available = {}  # length -> bitset of words that can still be used
+        self.bits = {}  # word -> bit in the bitset of its length
+        self.letters = set()
+
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def add(self, word):
+        """Adds a word to the index. Words that are already indexed are ignored."""
+        if word in self.bits:
+            return
+
+        length = len(word)
+        same_length = self.words.setdefault(length, [])
+        bit = 1 << len(same_length)
+        same_length.append(word)
+
+        for position, letter in enumerate(word):
+            key = (length, position, letter)
+            self.masks[key] = self.masks.get(key, 0) | bit
+            self.letters.add(letter)
+
+        self.available[length] = self.available.get(length, 0) | bit
+        self.bits[word] = bit
+
+    def remove(self, word):
+        """Marks a word as used, so that it is no longer returned by lookups."""
+        bit = self.bits.get(word)
+        if bit is not None:
+            self.available[len(word)] &= ~bit
+
+    def restore(self, word):
+        """Makes a used word available to lookups again."""
+        bit = self.bits.get(word)
+        if bit is not None:
+            self.available[len(word)] |= bit
+
+    def lengths(self):
+        """Returns the lengths of the words that can still be used."""
+        return [length for length, mask in self.available.items() if mask]
+
+    def match(self, pattern, allowed=None):
+        """Returns the bitset of available words matching the given pattern.
+
+        The pattern is a sequence of cells, where 0 matches any letter. If given,
+        allowed maps positions to the letters words may have there.
+        """
+        length = len(pattern)
+        mask = self.available.get(length, 0)
+
+        for position, letter in enumerate(pattern):
+            if not mask:
+                break
+            if letter != 0:
+                mask &= self.masks.get((length, position, letter), 0)
+
+        for position, letters in (allowed or {}).items():
+            if not mask:
+                break
+            any_letter = 0
+            for letter in letters:
+                any_letter |= self.masks.get((length, position, letter), 0)
+            mask &= any_letter
+
+        return mask
+
+    def letters_at(self, pattern, position):
+        """Returns the letters that the available words matching the pattern have
+        at the given position, usually a blank cell of the pattern."""
+        mask = self.match(pattern)
+        length = len(pattern)
+
+        return [
+            letter
+            for letter in self.letters
+            if mask & self.masks.get((length, position, letter), 0)
+        ]
+
+    @metrics.timed("dictionary_lookup")
+    def find(self, pattern, limit=None, rng=random, allowed=None):
+        """Returns the available words matching the given pattern (see match).
+
+        If a limit is given, at most that many words are returned, starting at a
+        random point of the bitset so that repeated lookups don't favour the first
+        words of the list.
+        """
+        mask = self.match(pattern, allowed)
+        if not mask:
+            return []
+
+        same_length = self.words[len(pattern)]
+
+        # Rotate the bitset by a random offset
+        offset = rng.randrange(len(same_length)) if limit else 0
+        parts = [(mask >> offset, offset), (mask & ((1 << offset) - 1), 0)]
+
+        found = []
+        for part, start in parts:
+            while part:
+                lowest = part & -part
+                found.append(same_length[start + lowest.bit_length() - 1])
+                if limit and len(found) >= limit:
+                    return found
+                part ^= lowest
+
+        return found